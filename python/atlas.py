@@ -0,0 +1,91 @@
+import os
+import glob
+import logging
+import threading
+import urllib.request
+from PIL import Image, ImageEnhance
+
+logger = logging.getLogger(__name__)
+
+# Moon phases are the Emojione new moon..waning crescent images, 1F311-1F318
+moon_phases = range(11, 19)
+
+class IconAtlas:
+    """Moon phases and OpenWeatherMap icons, decoded and sized once.
+
+    Sprites are keyed by (name, size) where name is "moon-NN" for a phase
+    or the OpenWeatherMap icon code ("10d", "01n", ...). Each one is the
+    32x32 box the weather screen draws, scaled to the requested size.
+    Unknown icon codes are downloaded in the background and show up as an
+    empty box until they arrive.
+    """
+
+    sizes = (32, 16)
+
+    def __init__(self, image_cache=""):
+        self.image_cache = image_cache
+        self.sprites = {}
+        self.version = 0
+        self.pending = set()
+        self.lock = threading.Lock()
+
+        for phase in moon_phases:
+            self._add_moon(phase)
+
+        for filename in glob.glob("%s/weather-*.png" % self.image_cache):
+            code = os.path.basename(filename)[len("weather-"):-len(".png")]
+            self._add_weather(code, filename)
+
+        self.blank = Image.new('RGBA', (32, 32), (0, 0, 0))
+
+    def _add(self, name, box):
+        with self.lock:
+            for size in self.sizes:
+                self.sprites[(name, size)] = box if size == 32 else box.resize((size, size))
+            self.version += 1
+
+    def _add_moon(self, phase):
+        moonImage = Image.open("%s/Emojione_1F3%2.2d.svg.png" % (self.image_cache, phase))
+
+        # planets() draws the bare moon at 12px; icon() boxes it at 20px
+        self.sprites[("moon-%2.2d" % phase, 12)] = ImageEnhance.Brightness(moonImage.resize((12, 12))).enhance(0.75)
+
+        iconBox = Image.new('RGBA', (32, 32), (0, 0, 0))
+        moonDim = ImageEnhance.Brightness(moonImage.resize((20, 20))).enhance(0.75)
+        iconBox.alpha_composite(moonDim, dest=(6, 6))
+        self._add("moon-%2.2d" % phase, iconBox)
+
+    def _add_weather(self, code, filename):
+        iconBox = Image.new('RGBA', (32, 32), (0, 0, 0))
+        iconImage = Image.open(filename).convert('RGBA')
+        iconImage = iconImage.crop((3, 3, 45, 45)).resize((32, 32))
+        iconBox.alpha_composite(iconImage, dest=(0, 0))
+        self._add(code, iconBox)
+
+    def _fetch(self, code):
+        url = "http://openweathermap.org/img/wn/%s.png" % code
+        filename = "%s/weather-%s.png" % (self.image_cache, code)
+        try:
+            logger.warning("Getting %s" % url)
+            urllib.request.urlretrieve(url, filename)
+            self._add_weather(code, filename)
+        except (urllib.error.URLError, OSError) as err:
+            logger.error("Problem getting weather icon %s: %s" % (code, err))
+        finally:
+            with self.lock:
+                self.pending.discard(code)
+
+    def moon(self, phase, size=32):
+        return self.sprites[("moon-%2.2d" % phase, size)]
+
+    def weather(self, code, size=32):
+        sprite = self.sprites.get((code, size))
+        if sprite is not None:
+            return sprite
+
+        with self.lock:
+            if code not in self.pending:
+                self.pending.add(code)
+                threading.Thread(target=self._fetch, args=(code,), daemon=True).start()
+
+        return self.blank if size == 32 else self.blank.resize((size, size))
@@ -0,0 +1,171 @@
+import numpy
+from PIL import Image
+
+# An RGBA image and a numpy array over the same memory, so frames can be
+# worked on with numpy and handed on as images without copying either way.
+# PIL marks such images read-only and would copy on the first write;
+# clearing that makes writes land in the array.
+def shared_image(size, color=(0, 0, 0, 255)):
+    pixels = numpy.empty((size[1], size[0], 4), dtype=numpy.uint8)
+    pixels[:] = color
+    image = Image.frombuffer("RGBA", size, pixels, "raw", "RGBA", 0, 1)
+    image.readonly = 0
+    image.pixels = pixels
+    return image
+
+# alpha_composite() of src over an opaque dst, to the bit, in the given
+# uint32 scratch buffers: with dst alpha at 255 PIL's blend comes down to
+# (x * 128 + 0x4000) / 255 >> 7 where x = src * a + dst * (255 - a).
+# Everything is widened with copyto() first and alpha is spread over all
+# three channels, as a ufunc that mixes uint8 and uint32, broadcasts, or
+# works on strided scratch makes its own buffers.
+def blend(dst, src, work, scratch, alpha):
+    numpy.copyto(alpha, src[..., 3:])
+    numpy.copyto(work, src[..., :3])
+    numpy.multiply(work, alpha, out=work)
+    numpy.subtract(255, alpha, out=alpha)
+    numpy.copyto(scratch, dst)
+    numpy.multiply(scratch, alpha, out=scratch)
+    numpy.add(work, scratch, out=work)
+    numpy.left_shift(work, 7, out=work)
+    numpy.add(work, 0x4000, out=work)
+    numpy.right_shift(work, 8, out=scratch)
+    numpy.add(work, scratch, out=work)
+    numpy.right_shift(work, 15, out=work)
+    numpy.copyto(dst, work, casting="unsafe")
+
+class Layer:
+    """An RGBA image placed on the frame.
+
+    Setting the same image object again is free; anything that changes
+    what the layer covers marks the old and new areas dirty. The pixels
+    are read out once when the image is set, so images that are redrawn
+    in place (like Conway's board) need touch().
+    """
+
+    def __init__(self, name, position=(0, 0), z=0):
+        self.name = name
+        self.image = None
+        self.pixels = None
+        self.position = position
+        self.z = z
+        self.visible = False
+        self.dirty = []
+
+    @property
+    def box(self):
+        if self.image is None or not self.visible:
+            return None
+        x, y = self.position
+        return (x, y, x + self.image.width, y + self.image.height)
+
+    def _mark(self):
+        if self.box:
+            self.dirty.append(self.box)
+
+    def set(self, image, position=None):
+        position = position or self.position
+        if image is self.image and position == self.position:
+            return
+        self._mark()
+        if image is not self.image:
+            self.pixels = None if image is None else numpy.asarray(image)
+        self.image = image
+        self.position = position
+        self._mark()
+
+    def move(self, position):
+        self.set(self.image, position)
+
+    def show(self, visible=True):
+        if visible == self.visible:
+            return
+        self._mark()
+        self.visible = visible
+        self._mark()
+
+    def hide(self):
+        self.show(False)
+
+    def touch(self):
+        if self.image is not None:
+            self.pixels = numpy.asarray(self.image)
+        self._mark()
+
+def union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def intersect(a, b):
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return None
+    return box
+
+class Compositor:
+    """Keeps a frame buffer and only redraws the parts that changed.
+
+    Layers are drawn bottom to top by z. On render() the dirty boxes of
+    every layer are merged and just that area is cleared and recomposited
+    in place. The frame handed out is always the same shared_image() and
+    the blending works in scratch buffers made up front, so a frame costs
+    no allocations, and one where nothing moved costs nothing at all.
+    version changes whenever the frame does. The background must be
+    opaque.
+    """
+
+    def __init__(self, size=(64, 64), background=(0, 0, 0, 255)):
+        self.size = size
+        self.background = background
+        self.layers = {}
+        self.buffer = shared_image(size, background)
+        self.pixels = self.buffer.pixels
+        # Flat, so any area's scratch can be a contiguous view of the start
+        self.work = numpy.zeros(size[0] * size[1] * 3, dtype=numpy.uint32)
+        self.scratch = numpy.zeros(size[0] * size[1] * 3, dtype=numpy.uint32)
+        self.alpha = numpy.zeros(size[0] * size[1] * 3, dtype=numpy.uint32)
+        self.version = 0
+
+    def add(self, name, position=(0, 0), z=0):
+        self.layers[name] = Layer(name, position, z)
+        return self.layers[name]
+
+    def __getitem__(self, name):
+        return self.layers[name]
+
+    def only(self, *names):
+        """Show the named layers and hide the rest."""
+        for name, layer in self.layers.items():
+            layer.show(name in names)
+
+    def render(self):
+        damage = None
+        for layer in self.layers.values():
+            for box in layer.dirty:
+                damage = box if damage is None else union(damage, box)
+            layer.dirty = []
+
+        if damage is None:
+            return self.buffer
+
+        damage = intersect(damage, (0, 0) + self.size)
+        if damage is None:
+            return self.buffer
+
+        left, top, right, bottom = damage
+        self.pixels[top:bottom, left:right] = self.background
+        for layer in sorted(self.layers.values(), key=lambda l: l.z):
+            box = layer.box
+            if box is None:
+                continue
+            overlap = intersect(box, damage)
+            if overlap is None:
+                continue
+            x, y = layer.position
+            shape = (overlap[3] - overlap[1], overlap[2] - overlap[0], 3)
+            n = shape[0] * shape[1] * 3
+            blend(self.pixels[overlap[1]:overlap[3], overlap[0]:overlap[2], :3],
+                  layer.pixels[overlap[1] - y:overlap[3] - y, overlap[0] - x:overlap[2] - x],
+                  self.work[:n].reshape(shape), self.scratch[:n].reshape(shape), self.alpha[:n].reshape(shape))
+
+        self.version += 1
+        return self.buffer
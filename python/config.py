@@ -1 +1,171 @@
-config = { "weather": None, "music": None, "frame": None, "config": None }
\ No newline at end of file
+import configparser
+import logging
+import os
+from dataclasses import dataclass, replace
+from transitions import Transition
+
+logger = logging.getLogger(__name__)
+
+config = { "weather": None, "music": None, "frame": None, "config": None, "settings": None }
+
+class SettingsError(Exception):
+    pass
+
+@dataclass(frozen=True)
+class MatrixSettings:
+    width: int
+    height: int
+    brightness: int
+    gamma: float
+    padding_left: int = 0
+    padding_top: int = 0
+    transition: str = "crossfade"
+    multiprocess: bool = False
+    display_fps: float = 60.0
+
+@dataclass(frozen=True)
+class FontSettings:
+    time: str
+    music: str
+    music_italic: str
+    weather: str
+
+# A receiver for streamed frames, from a [display <name>] section. The
+# display shows the width x height window at (x, y) of the rendered frame.
+@dataclass(frozen=True)
+class DisplaySettings:
+    name: str
+    host: str
+    port: int
+    transport: str
+    gamma: float
+    width: int
+    height: int
+    x: int = 0
+    y: int = 0
+    padding_left: int = 0
+    padding_top: int = 0
+
+@dataclass(frozen=True)
+class Settings:
+    matrix: MatrixSettings
+    fonts: FontSettings
+    path: str
+    mtime: float
+    displays: tuple = ()
+
+def _get(parser, section, key, kind, default=None):
+    try:
+        if kind is bool:
+            value = parser.getboolean(section, key)
+        else:
+            value = kind(parser.get(section, key))
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        if default is None:
+            raise SettingsError("Missing [%s] %s" % (section, key))
+        return default
+    except ValueError as err:
+        raise SettingsError("Bad [%s] %s: %s" % (section, key, err))
+    return value
+
+def parse(path):
+    """Read path into a (parser, Settings) pair, or raise SettingsError."""
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise SettingsError("Can't read %s" % path)
+
+    matrix = MatrixSettings(
+        width=_get(parser, "matrix", "width", int),
+        height=_get(parser, "matrix", "height", int),
+        brightness=_get(parser, "matrix", "brightness", int),
+        gamma=_get(parser, "matrix", "gamma", float),
+        padding_left=_get(parser, "matrix", "padding_left", int, 0),
+        padding_top=_get(parser, "matrix", "padding_top", int, 0),
+        transition=_get(parser, "matrix", "transition", str, "crossfade"),
+        multiprocess=_get(parser, "matrix", "multiprocess", bool, False),
+        display_fps=_get(parser, "matrix", "display_fps", float, 60.0))
+
+    if not 0 <= matrix.brightness <= 100:
+        raise SettingsError("[matrix] brightness must be 0-100")
+    if matrix.gamma <= 0.0:
+        raise SettingsError("[matrix] gamma must be positive")
+    if not (0 <= matrix.padding_left < matrix.width and 0 <= matrix.padding_top < matrix.height):
+        raise SettingsError("[matrix] padding is larger than the matrix")
+    if matrix.transition not in Transition.kinds:
+        raise SettingsError("[matrix] transition must be one of %s" % ", ".join(Transition.kinds))
+
+    fonts = FontSettings(**{ key: _get(parser, "fonts", key, str) for key in ("time", "music", "music_italic", "weather") })
+    for key, font in vars(fonts).items():
+        if not os.path.isfile(font):
+            raise SettingsError("[fonts] %s: no such file %s" % (key, font))
+
+    displays = []
+    if parser.has_section("stream"):
+        for name in _get(parser, "stream", "displays", str).split(","):
+            section = "display %s" % name.strip()
+            display = DisplaySettings(
+                name=name.strip(),
+                host=_get(parser, section, "host", str),
+                port=_get(parser, section, "port", int, 7000),
+                transport=_get(parser, section, "transport", str, "udp"),
+                gamma=_get(parser, section, "gamma", float, matrix.gamma),
+                width=_get(parser, section, "width", int, matrix.width),
+                height=_get(parser, section, "height", int, matrix.height),
+                x=_get(parser, section, "x", int, 0),
+                y=_get(parser, section, "y", int, 0),
+                padding_left=_get(parser, section, "padding_left", int, 0),
+                padding_top=_get(parser, section, "padding_top", int, 0))
+            if display.transport not in ("udp", "tcp"):
+                raise SettingsError("[%s] transport must be udp or tcp" % section)
+            if display.gamma <= 0.0:
+                raise SettingsError("[%s] gamma must be positive" % section)
+            displays.append(display)
+
+    return parser, Settings(matrix=matrix, fonts=fonts, path=path, mtime=os.path.getmtime(path), displays=tuple(displays))
+
+def sections(parser):
+    return { name: dict(parser[name]) for name in parser.sections() }
+
+subscribers = []
+
+def subscribe(callback):
+    """Call callback(old, new) whenever the settings are reloaded."""
+    subscribers.append(callback)
+
+def load(path):
+    config["config"], config["settings"] = parse(path)
+    return config["settings"]
+
+def reload():
+    """Re-read the settings file, keeping the old settings if it's bad."""
+    old = config["settings"]
+    try:
+        parser, new = parse(old.path)
+    except SettingsError as err:
+        logger.error("Not reloading settings: %s" % err)
+        # Don't keep retrying the same broken file
+        try:
+            config["settings"] = replace(old, mtime=os.path.getmtime(old.path))
+        except OSError:
+            pass
+        return False
+
+    if new.matrix == old.matrix and new.fonts == old.fonts and new.displays == old.displays and sections(parser) == sections(config["config"]):
+        config["settings"] = new
+        return False
+
+    config["config"], config["settings"] = parser, new
+    logger.warning("Reloaded settings from %s" % new.path)
+    for callback in subscribers:
+        try:
+            callback(old, new)
+        except Exception as err:
+            logger.error("Settings subscriber %s failed: %s" % (callback, err))
+    return True
+
+def changed():
+    """True if the settings file has been modified since it was read."""
+    try:
+        return os.path.getmtime(config["settings"].path) != config["settings"].mtime
+    except OSError:
+        return False
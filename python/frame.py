@@ -0,0 +1,215 @@
+import atexit
+import logging
+import time
+import types
+from dataclasses import replace
+import numpy
+from PIL import Image
+from framering import start_display
+from recording import Recorder
+from streaming import Display
+from lazy import Lazy
+from config import config
+import config as configuration
+
+logger = logging.getLogger(__name__)
+
+# A render host that only streams doesn't need the matrix library
+rgbmatrix = Lazy("rgbmatrix")
+
+# Dimming at night is folded into the same lookup, truncating the way
+# ImageEnhance.Brightness(0.5) did.
+def gamma_tables(gamma):
+    day = [round(pow(value / 255.0, gamma) * 255.0) for value in range(256)]
+    return numpy.array(day, dtype=numpy.uint8), numpy.array([int(value * 0.5) for value in day], dtype=numpy.uint8)
+
+# The compositor and transitions hand over shared images whose pixels can be
+# read directly; anything else (a replayed frame, say) is copied out once.
+def pixels(canvas):
+    shared = getattr(canvas, "pixels", None)
+    if shared is not None:
+        return shared[..., :3]
+    return numpy.asarray(canvas if canvas.mode == "RGB" else canvas.convert("RGB"))
+
+class Frame:
+    def __init__(self):
+        matrix = config["settings"].matrix
+        self.options = self.new_options()
+        self.options.brightness = matrix.brightness
+        self.options.hardware_mapping = "adafruit-hat-pwm"
+        self.options.rows = matrix.height
+        self.options.cols = matrix.width
+        
+        self.count = 0
+        self.t0 = time.time()
+        self.last = None
+        self.prepared = 0
+        self.images = Image.core.get_stats()["new_count"]
+        self._shown = None
+        self._output = None
+        self._pixels = None
+        self._index = None
+        self._image = None
+        self.recorder = None
+
+        self.configure(matrix)
+        self.open()
+        configuration.subscribe(self.reconfigure)
+
+    def configure(self, matrix):
+        self.padding_left = matrix.padding_left
+        self.padding_top = matrix.padding_top
+        self.width = self.options.cols - self.padding_left
+        self.height = self.options.rows - self.padding_top
+        self.gamma, self.night_gamma = gamma_tables(matrix.gamma)
+        self._shown = None
+
+    def reconfigure(self, old, new):
+        if (old.matrix.width, old.matrix.height, old.matrix.multiprocess) != (new.matrix.width, new.matrix.height, new.matrix.multiprocess):
+            logger.warning("Matrix size and multiprocess changes need a restart")
+        self.configure(new.matrix)
+        if old.matrix.brightness != new.matrix.brightness:
+            self.brightness(new.matrix.brightness)
+
+    def brightness(self, brightness):
+        self.matrix.brightness = brightness
+
+    def new_options(self):
+        return rgbmatrix.RGBMatrixOptions()
+
+    def open(self):
+        self.matrix = rgbmatrix.RGBMatrix(options=self.options)
+        self.offscreen_canvas = self.matrix.CreateFrameCanvas()
+    
+    @property
+    def square(self):
+        return self.options.cols == self.options.rows
+
+    def record(self, path):
+        self.recorder = Recorder(path)
+        atexit.register(self.recorder.close)
+
+    # version identifies the canvas contents when the caller reuses the same
+    # image (like the compositor's buffer); an unchanged frame is shown again
+    # without being recalculated. night is normally up to the weather.
+    # started is when the caller began building the canvas, so a recording
+    # shows render time and not whatever else ran since the last frame.
+    def swap(self, canvas, version=None, night=None, started=None):
+        self.count += 1
+        self.last = canvas
+        if night is None:
+            night = config["weather"].night
+
+        if self.recorder:
+            self.recorder.write(canvas, night, 0.0 if started is None else time.monotonic() - started)
+
+        key = (id(canvas), version, night)
+        if version is None or key != self._shown:
+            self._output = self.prepare(canvas, night)
+            self._shown = key
+            self.prepared += 1
+
+        self.show(self._output, self.padding_left, self.padding_top)
+
+    # The gamma lookup goes into the same array every frame, and from there
+    # into the same image for the matrix. take() would make its own intp
+    # copy of uint8 indices each call, so they're widened into a buffer.
+    def lookup(self, canvas, night):
+        source = pixels(canvas)
+        if self._pixels is None or self._pixels.shape != source.shape:
+            self._pixels = numpy.empty(source.shape, dtype=numpy.uint8)
+            self._index = numpy.empty(source.shape, dtype=numpy.intp)
+        numpy.copyto(self._index, source)
+        numpy.take(self.night_gamma if night else self.gamma, self._index, out=self._pixels, mode="clip")
+        return self._pixels
+
+    def prepare(self, canvas, night):
+        output = self.lookup(canvas, night)
+        if self._image is None or self._image.size != (output.shape[1], output.shape[0]):
+            self._image = Image.new("RGB", (output.shape[1], output.shape[0]))
+        self._image.frombytes(output)
+        return self._image
+
+    def show(self, canvas, padding_left, padding_top):
+        self.offscreen_canvas.SetImage(canvas, padding_left, padding_top)
+        self.offscreen_canvas = self.matrix.SwapOnVSync(self.offscreen_canvas)
+
+    # PIL counts every image it creates, here or anywhere else in the
+    # process, so this is what rendering really allocates per frame
+    def fps(self):
+        t1 = time.time()
+        images = Image.core.get_stats()["new_count"]
+        logger.warning("FPS: %0.2f (%d in %0.2f secs, output prepared for %0.0f%% of frames, %0.1f images allocated per frame)" % (self.count / (t1 - self.t0), self.count, (t1 - self.t0), 100.0 * self.prepared / max(self.count, 1), (images - self.images) / max(self.count, 1)))
+        self.t0 = t1
+        self.count = 0
+        self.prepared = 0
+        self.images = images
+
+# Renders into a shared memory ring that a separate display process pushes
+# to the matrix, so render stalls don't hold up the panel refresh.
+class RingFrame(Frame):
+    def open(self):
+        options = {
+            "brightness": self.options.brightness,
+            "hardware_mapping": self.options.hardware_mapping,
+            "rows": self.options.rows,
+            "cols": self.options.cols,
+        }
+        padding = self.ring_padding = (self.padding_left, self.padding_top)
+        fps = config["settings"].matrix.display_fps
+        self.ring, self.display = start_display((self.width, self.height), options, padding, fps=fps)
+        atexit.register(self.ring.unlink)
+
+    # The display process was handed the padding, and the ring its size,
+    # when it started, so those stay as they were until a restart
+    def reconfigure(self, old, new):
+        if (new.matrix.padding_left, new.matrix.padding_top) != self.ring_padding:
+            logger.warning("Padding changes need a restart in multiprocess mode")
+            new = replace(new, matrix=replace(new.matrix, padding_left=self.ring_padding[0], padding_top=self.ring_padding[1]))
+        super().reconfigure(old, new)
+
+    def brightness(self, brightness):
+        logger.warning("Brightness changes need a restart in multiprocess mode")
+
+    # The ring takes the looked up array as it is
+    def prepare(self, canvas, night):
+        return self.lookup(canvas, night)
+
+    def show(self, pixels, padding_left, padding_top):
+        self.ring.write(pixels)
+
+    def fps(self):
+        if not self.display.is_alive():
+            logger.error("Display process exited: %s" % self.display.exitcode)
+        super().fps()
+
+# Renders once and streams each [display <name>] its own copy, with its own
+# gamma and window onto the frame, for receive-frames.py to show.
+class StreamFrame(Frame):
+    def new_options(self):
+        return types.SimpleNamespace()
+
+    def open(self):
+        self.displays = [Display(display, *gamma_tables(display.gamma)) for display in config["settings"].displays]
+        logger.warning("Streaming to %s" % ", ".join("%s (%s:%d %s)" % (d.name, d.host, d.port, d.transport) for d in config["settings"].displays))
+
+    def close(self):
+        for display in self.displays:
+            display.close()
+
+    def reconfigure(self, old, new):
+        super().reconfigure(old, new)
+        if old.displays != new.displays:
+            self.close()
+            self.open()
+
+    def brightness(self, brightness):
+        logger.warning("Brightness is set on each receiver")
+
+    def prepare(self, canvas, night):
+        source = pixels(canvas)
+        return [display.prepare(source, night) for display in self.displays]
+
+    def show(self, prepared, padding_left, padding_top):
+        for display, frame in zip(self.displays, prepared):
+            display.send(frame)
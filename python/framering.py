@@ -0,0 +1,137 @@
+import logging
+import multiprocessing
+import time
+import numpy
+from multiprocessing import shared_memory
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+class FrameRing:
+    """Fixed-size RGB frames in shared memory, one writer and one reader.
+
+    The block starts with a header of int64s: the sequence number of the
+    newest frame, then the sequence number each slot holds. The writer marks
+    a slot -1 while it copies into it, so a reader that races the writer
+    can tell and just picks up the newer frame instead.
+    """
+
+    def __init__(self, shm, size, slots):
+        self.shm = shm
+        self.size = size
+        self.slots = slots
+        width, height = size
+
+        self.header = numpy.ndarray((slots + 1,), dtype=numpy.int64, buffer=shm.buf)
+        self.frames = numpy.ndarray((slots, height, width, 3), dtype=numpy.uint8, buffer=shm.buf, offset=self.header.nbytes)
+        self.local = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+
+    @classmethod
+    def nbytes(cls, size, slots):
+        width, height = size
+        return (slots + 1) * 8 + slots * width * height * 3
+
+    @classmethod
+    def create(cls, size, slots=4):
+        shm = shared_memory.SharedMemory(create=True, size=cls.nbytes(size, slots))
+        ring = cls(shm, size, slots)
+        ring.header[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name, size, slots=4):
+        return cls(shared_memory.SharedMemory(name=name), size, slots)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def latest(self):
+        return int(self.header[0])
+
+    # pixels is an RGB array; a frame that doesn't fit is cut or padded
+    # with black to the ring's size
+    def write(self, pixels):
+        width, height = self.size
+        seq = self.latest + 1
+        slot = seq % self.slots
+        self.header[slot + 1] = -1
+        if pixels.shape[:2] == (height, width):
+            numpy.copyto(self.frames[slot], pixels)
+        else:
+            self.frames[slot].fill(0)
+            fit = pixels[:height, :width]
+            self.frames[slot][:fit.shape[0], :fit.shape[1]] = fit
+        self.header[slot + 1] = seq
+        self.header[0] = seq
+
+    def read(self):
+        """Copy of the newest complete frame and its sequence number."""
+        while True:
+            seq = self.latest
+            if seq == 0:
+                return 0, None
+            slot = seq % self.slots
+            numpy.copyto(self.local, self.frames[slot])
+            if self.header[slot + 1] == seq:
+                return seq, self.local
+
+    def close(self):
+        self.header = None
+        self.frames = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+def display_loop(name, size, slots, options, padding, fps):
+    """Run in its own process: push the newest frame to the matrix.
+
+    This process does nothing but copy a frame out of the ring and call
+    SetImage/SwapOnVSync, so renderer pauses don't show up as jitter.
+    """
+    from rgbmatrix import RGBMatrix, RGBMatrixOptions
+
+    matrix_options = RGBMatrixOptions()
+    for key, value in options.items():
+        setattr(matrix_options, key, value)
+    matrix = RGBMatrix(options=matrix_options)
+    offscreen_canvas = matrix.CreateFrameCanvas()
+
+    ring = FrameRing.attach(name, size, slots)
+    padding_left, padding_top = padding
+    interval = 1.0 / fps
+    shown = 0
+    t0 = time.time()
+    next_frame = time.monotonic()
+
+    while True:
+        seq, pixels = ring.read()
+        if pixels is not None:
+            offscreen_canvas.SetImage(Image.fromarray(pixels, "RGB"), padding_left, padding_top)
+            offscreen_canvas = matrix.SwapOnVSync(offscreen_canvas)
+            shown += 1
+
+        if time.time() - t0 > 60.0:
+            logger.warning("Display FPS: %0.2f" % (shown / (time.time() - t0)))
+            shown = 0
+            t0 = time.time()
+
+        next_frame += interval
+        delay = next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_frame = time.monotonic()
+
+def start_display(size, options, padding, fps=60.0, slots=4):
+    """Create a ring and the display process reading it.
+
+    The process is forked, so call this before any backend threads start.
+    """
+    ring = FrameRing.create(size, slots)
+    context = multiprocessing.get_context("fork")
+    process = context.Process(target=display_loop, args=(ring.name, size, slots, options, padding, fps), daemon=True)
+    process.start()
+    return ring, process
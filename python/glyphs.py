@@ -0,0 +1,98 @@
+import numpy
+from PIL import Image, ImageDraw
+
+class GlyphFont:
+    """A FreeType font rasterized one glyph at a time and cached.
+
+    The small fonts on the matrix are effectively bitmap fonts, so once a
+    glyph has been rendered we can place it by its advance (plus kerning)
+    instead of asking FreeType to lay out the whole string again. Lines are
+    assembled into a mask with NumPy and inked the same way ImageDraw.text
+    does, so for fonts drawn on the pixel grid the output matches
+    multiline_text with spacing=0.
+    """
+
+    def __init__(self, font, fontmode="L"):
+        self.font = font
+        self.fontmode = fontmode
+        self.glyphs = {}
+        self.kerning = {}
+
+        scratch = ImageDraw.Draw(Image.new("L", (1, 1)))
+        self.line_height = scratch.multiline_textbbox((0, 0), "A\nA", font=font, spacing=0)[3] - scratch.textbbox((0, 0), "A", font=font)[3]
+
+    def glyph(self, ch):
+        if ch not in self.glyphs:
+            l, t, r, b = self.font.getbbox(ch, mode=self.fontmode)
+            if r > l and b > t:
+                image = Image.new("L", (r - l, b - t), 0)
+                draw = ImageDraw.Draw(image)
+                draw.fontmode = self.fontmode
+                draw.text((-l, -t), ch, fill=255, font=self.font)
+                mask = numpy.asarray(image)
+            else:
+                mask = None
+            self.glyphs[ch] = (mask, l, t, self.font.getlength(ch, mode=self.fontmode))
+        return self.glyphs[ch]
+
+    def kern(self, a, b):
+        if (a, b) not in self.kerning:
+            self.kerning[(a, b)] = self.font.getlength(a + b, mode=self.fontmode) - self.font.getlength(a, mode=self.fontmode) - self.font.getlength(b, mode=self.fontmode)
+        return self.kerning[(a, b)]
+
+    def layout(self, line):
+        """(mask, x, y) for each visible glyph in a line."""
+        placed = []
+        pen = 0.0
+        prev = None
+        for ch in line:
+            if prev is not None:
+                pen += self.kern(prev, ch)
+            mask, l, t, advance = self.glyph(ch)
+            if mask is not None:
+                placed.append((mask, int(pen) + l, t))
+            pen += advance
+            prev = ch
+        return placed
+
+    def line_mask(self, line):
+        """Mask for a single line and the offset of its top left corner."""
+        placed = self.layout(line)
+        if not placed:
+            return None, (0, 0)
+
+        x0 = min(x for mask, x, y in placed)
+        y0 = min(y for mask, x, y in placed)
+        x1 = max(x + mask.shape[1] for mask, x, y in placed)
+        y1 = max(y + mask.shape[0] for mask, x, y in placed)
+
+        out = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.uint8)
+        for mask, x, y in placed:
+            h, w = mask.shape
+            region = out[y - y0:y - y0 + h, x - x0:x - x0 + w]
+            numpy.maximum(region, mask, out=region)
+        return out, (x0, y0)
+
+    def textbbox(self, xy, text):
+        x, y = xy
+        l = t = r = b = None
+        for n, line in enumerate(text.split("\n")):
+            mask, (ox, oy) = self.line_mask(line)
+            if mask is None:
+                continue
+            ly = y + n * self.line_height + oy
+            l = x + ox if l is None else min(l, x + ox)
+            t = ly if t is None else min(t, ly)
+            r = x + ox + mask.shape[1] if r is None else max(r, x + ox + mask.shape[1])
+            b = ly + mask.shape[0] if b is None else max(b, ly + mask.shape[0])
+        if l is None:
+            return (x, y, x, y)
+        return (l, t, r, b)
+
+    def text(self, image, xy, text, fill):
+        draw = ImageDraw.Draw(image)
+        x, y = xy
+        for n, line in enumerate(text.split("\n")):
+            mask, (ox, oy) = self.line_mask(line)
+            if mask is not None:
+                draw.bitmap((x + ox, y + n * self.line_height + oy), Image.fromarray(mask, "L"), fill=fill)
@@ -0,0 +1,88 @@
+import re
+import logging
+from collections import OrderedDict
+from matcher import normalize_string, title_key, artist_key
+
+logger = logging.getLogger(__name__)
+
+# Sources disagree on how to write the same thing: Spotify joins artists
+# with ", ", Plex may use "; " or "feat.", and albums pick up "(Deluxe
+# Edition)" or "[Remastered]" depending on who's serving them. Only those
+# edition suffixes are dropped; "(Blue Album)" and "(Green Album)" are
+# different albums.
+
+edition = r'\b(deluxe|remaster(ed)?|expanded|anniversary|edition|bonus|special|version|mono|stereo|explicit|reissue)\b'
+edition_suffix = re.compile(r'\s*([\(\[][^\)\]]*%s[^\)\]]*[\)\]]|\s-\s[^-]*%s.*$)' % (edition, edition), re.IGNORECASE)
+
+def primary_artist(artist):
+    return re.split(r',|;| & | feat\.? | ft\.? ', artist or "", maxsplit=1)[0]
+
+def album_name(album):
+    return edition_suffix.sub('', album or "")
+
+def album_names(track):
+    return (artist_key(primary_artist(track.artist)), normalize_string(album_name(track.album)))
+
+# Nameless tracks (radio, some casts) fall back to the source's own ids,
+# which for a cast are empty too, so the art tells streams apart
+def album_key(track):
+    key = album_names(track)
+    return key if any(key) else ("", track.album_id, track.art_url)
+
+def track_key(track):
+    key = album_names(track) + (title_key(track.track),)
+    return key if any(key) else ("", track.track_id, track.art_url)
+
+class Resolver:
+    """One identity for a track however it's being played, and a shared cache.
+
+    Tracks from every source map to (artist, album, title) keys built from
+    normalized names, so a song seen through Plex, a Chromecast and Spotify
+    at once is one song. Plex items and albums are fetched once however
+    many sources point at them, and processed album art is kept per album
+    rather than per source.
+
+    choose() still goes by source priority, but since album and track
+    changes are judged on these keys, the same song moving between sources
+    doesn't count as a change.
+    """
+
+    def __init__(self, plex=None, size=64):
+        self.plex = plex
+        self.size = size
+        self.items = OrderedDict()
+        self.albums = OrderedDict()
+        self.art = OrderedDict()
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.size:
+            cache.popitem(last=False)
+        return value
+
+    def _cached(self, cache, key, fetch):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        return self._remember(cache, key, fetch())
+
+    def plex_item(self, key):
+        return self._cached(self.items, key, lambda: self.plex.fetchItem(key))
+
+    def plex_album(self, item):
+        return self._cached(self.albums, item.parentRatingKey, item.album)
+
+    # Only named albums are cached; a fallback key says too little about
+    # the track to share its art
+    def album_art(self, track):
+        key = album_names(track)
+        if not all(key):
+            return track.image
+        return self._cached(self.art, key, lambda: track.image)
+
+    def choose(self, playing, order):
+        for source in order:
+            for _, track in playing.get(source, []):
+                return track
+        return None
@@ -0,0 +1,46 @@
+import importlib
+import logging
+import resource
+import time
+
+logger = logging.getLogger(__name__)
+
+# (name, secs, KiB of peak RSS growth) for each module imported through Lazy
+timings = []
+reported = 0
+
+def load(name):
+    t0 = time.monotonic()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    module = importlib.import_module(name)
+    timings.append((name, time.monotonic() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss))
+    return module
+
+class Lazy:
+    """A module that isn't imported until something on it is used.
+
+    Backends are only wanted when they're configured, and several of them
+    take seconds to import on a Pi, so music and weather hold their
+    dependencies this way. The first attribute lookup does the import.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = load(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return "<lazy module %s%s>" % (self._name, "" if self._module else " (not loaded)")
+
+# Logs the imports since the last report
+def report(startup=None):
+    global reported
+    if startup is not None:
+        logger.warning("Startup took %0.2f secs" % startup)
+    for name, secs, rss in timings[reported:]:
+        logger.warning("Imported %s in %0.2f secs, +%d KiB" % (name, secs, rss))
+    reported = len(timings)
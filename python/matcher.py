@@ -0,0 +1,89 @@
+import re
+from functools import lru_cache
+
+# Normalization matches what spotify-get-likes.py has always done: drop
+# " - Remastered 2011" style suffixes from titles, then lowercase, strip a
+# leading "The " and anything that isn't a letter, digit or space.
+
+@lru_cache(maxsize=None)
+def normalize_track(title):
+    return re.sub(r' - (\d+ )?Remaster(ed)?( \d+)?', '', title).strip()
+
+@lru_cache(maxsize=None)
+def normalize_string(title):
+    return re.sub(r'[^a-z0-9 ]', '', title.lower().removeprefix("the ").strip())
+
+def title_key(title):
+    return normalize_string(normalize_track(title)) if title else ""
+
+def artist_key(artist):
+    return normalize_string(artist) if artist else ""
+
+class Entry:
+    __slots__ = ("item", "title", "artists", "title_key", "artist_keys")
+
+    def __init__(self, item, title, artists):
+        self.item = item
+        self.title = title
+        self.artists = tuple(a for a in artists if a)
+        self.title_key = title_key(title)
+        self.artist_keys = tuple(artist_key(a) for a in self.artists)
+
+class TrackMatcher:
+    """Index of library tracks for resolving (title, artist) pairs.
+
+    Normalized keys are computed once when a track is added. A match needs
+    the normalized title to agree, so lookups only score the entries
+    sharing it and cost doesn't grow with the library size.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.by_title = {}
+        self.by_key = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, item, title, artists):
+        entry = Entry(item, title, artists)
+        n = len(self.entries)
+        self.entries.append(entry)
+        self.by_title.setdefault(entry.title_key, []).append(n)
+        return entry
+
+    def add_plex(self, tracks):
+        # grandparentTitle is the album artist, so there's no extra request
+        # per track the way artist().title needs.
+        for track in tracks:
+            self.by_key[track.ratingKey] = self.add(track, track.title, (track.grandparentTitle, track.originalTitle))
+        return self
+
+    def candidates(self, title, artist):
+        return (self.entries[n] for n in self.by_title.get(title_key(title), ()))
+
+    def score(self, entry, title, artist):
+        if artist in entry.artists:
+            artist_score = 2
+        elif artist_key(artist) in entry.artist_keys:
+            artist_score = 1
+        else:
+            return 0
+
+        if title == entry.title:
+            title_score = 2
+        elif title_key(title) == entry.title_key:
+            title_score = 1
+        else:
+            return 0
+
+        return artist_score + title_score
+
+    def match(self, title, artist):
+        """Best scoring entry for title/artist, or None when nothing matches."""
+        best, best_score = None, 0
+        for entry in self.candidates(title, artist):
+            score = self.score(entry, title, artist)
+            if score > best_score:
+                best, best_score = entry, score
+        return best
@@ -1,20 +1,28 @@
-import pychromecast
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from spotipy.cache_handler import CacheFileHandler
 import simplejson
+import io
 import os
 import sys
 import logging
+import threading
 import PIL
-from PIL import Image, ImageEnhance, ImageDraw, ImageOps, ImageStat, ImageFont
+from PIL import Image, ImageEnhance, ImageOps, ImageStat, ImageFont
 import urllib
-import requests
-from plexapi.server import PlexServer
-import plexapi
 from time import time
 from config import config
-from heospy import HeosPlayer
+import config as configuration
+from glyphs import GlyphFont
+from identity import Resolver, album_key, track_key
+from lazy import Lazy
+
+# Backends are only imported once a configured source uses them
+pychromecast = Lazy("pychromecast")
+spotipy = Lazy("spotipy")
+spotipy_cache = Lazy("spotipy.cache_handler")
+plexapi_server = Lazy("plexapi.server")
+plexapi_audio = Lazy("plexapi.audio")
+plexapi_exceptions = Lazy("plexapi.exceptions")
+heospy = Lazy("heospy")
+requests = Lazy("requests")
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +35,44 @@ image_cache = "%s/imagecache" % (basepath)
 class TrackError(Exception):
     pass
 
+art_size = 64
+
+# Failed polls in a row before a source's last tracks are dropped
+stale_after = 3
+
+# Sources list the same cover at several sizes (Spotify has 640, 300 and 64
+# pixels). Anything bigger than the frame is only downloaded to be thrown
+# away, so take the smallest that still covers it.
+def pick_image(images, size=art_size, default=0):
+    sized = []
+    for image in images:
+        if isinstance(image, dict):
+            url, width, height = image.get("url"), image.get("width"), image.get("height")
+        else:
+            url, width, height = image.url, image.width, image.height
+        if url and width and height:
+            sized.append((min(width, height), url))
+
+    fitting = [x for x in sized if x[0] >= size]
+    if fitting:
+        return min(fitting)[1]
+    elif sized:
+        return max(sized)[1]
+    elif images:
+        image = images[min(default, len(images) - 1)]
+        return image["url"] if isinstance(image, dict) else image.url
+    else:
+        return False
+
+def decode_art(data, size=art_size):
+    image = Image.open(io.BytesIO(data))
+    # For a JPEG this has the decoder scale down by up to 8x as it goes,
+    # never below size
+    image.draft("RGB", (size, size))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return ImageOps.pad(image, size=(size, size), method=Image.LANCZOS, centering=(1,0))
+
 class Track:
     def __init__(self):
         self.art_url = None
@@ -57,6 +103,11 @@ class Track:
         else:
             return self.duration - self.progress - self.data_age
 
+    # Tracks of unknown length (radio) never end
+    @property
+    def ended(self):
+        return self.duration >= 0 and self.progress >= 0 and self.timeleft <= 0
+
     @property
     def timein(self):
         if self.duration < 0 or self.progress < 0:
@@ -64,6 +115,13 @@ class Track:
         else:
             return self.progress + self.data_age
 
+    # The source says nothing changed, so carry our progress estimate forward
+    # as if we'd just fetched it.
+    def touch(self):
+        if self.progress >= 0:
+            self.progress = self.timein
+        self.checktime = time()
+
     def recheck_in(self):
         if self.timeleft < 0:
             return 5.0
@@ -94,11 +152,14 @@ class Track:
 
         try:
             with urllib.request.urlopen(url) as rawimage:
-                image = ImageOps.pad(Image.open(rawimage), size=(64,64), method=Image.LANCZOS, centering=(1,0))
-                image.save(processed, "PNG")
-                return image
+                image = decode_art(rawimage.read())
         except urllib.error.URLError as err:
             raise TrackError(f"Can't get image: {err} {self.track} {self}")
+        except PIL.UnidentifiedImageError as err:
+            raise TrackError(f"Can't read image: {err} {self.track} {self}")
+
+        image.save(processed, "PNG")
+        return image
 
     @property
     def image(self):
@@ -120,22 +181,25 @@ class Track:
         return image
 
 class PlexTrack(Track):
-    def __init__(self, item, client=None):
+    def __init__(self, item, client=None, album=None):
         super().__init__()
-        if not isinstance(item, plexapi.audio.Audio):
+        if not isinstance(item, plexapi_audio.Audio):
             raise TypeError("item must be a plexapi.audio.Audio object")
 
+        album = album or item.album()
         self.track = item.title
-        self.album = item.album().title
-        self.artist = item.originalTitle or item.artist().title
-        self.duration = client.timeline.duration / 1000.0
-        self.progress = client.timeline.time / 1000.0
+        self.album = album.title
+        # grandparentTitle is what artist().title would fetch
+        self.artist = item.originalTitle or item.grandparentTitle
+        if client:
+            self.duration = client.timeline.duration / 1000.0
+            self.progress = client.timeline.time / 1000.0
         
         # Plex specific instance variables
         self.item = item
         self.client = client
-        self.label = item.album().studio
-        self.year = item.album().year
+        self.label = album.studio
+        self.year = album.year
         self._album_id = item.parentRatingKey
         self._track_id = item.ratingKey
 
@@ -152,18 +216,19 @@ class PlexTrack(Track):
         art_url = self.item.parentThumb or self.item.grandparentThumb
         if not art_url:
             return super().get_image()
-        url = config["config"]["plex"]["base"] + art_url
-        path = plexapi.utils.download(url, config["config"]["plex"]["token"], filename=str(self.album_id), savepath="/tmp")
+
+        # Have Plex's transcoder scale the thumb rather than downloading
+        # the full size original
+        url = config["music"].plex.transcodeImage(art_url, art_size, art_size)
         try:
-            image = Image.open(path)
+            with urllib.request.urlopen(url) as rawimage:
+                image = decode_art(rawimage.read())
+        except urllib.error.URLError as err:
+            raise TrackError(f"Can't get image: {err} {self.track} {self}")
         except PIL.UnidentifiedImageError as err:
             raise TrackError(f"Can't get image: {err} {self.track} {self}")
 
-        image = ImageOps.pad(image, size=(64,64), centering=(1,0))
-        if image.mode != "RGB":
-            image = image.convert("RGB")
         image.save(processed, "PNG")
-        os.remove(path)
         return image
 
 class CastTrack(Track):
@@ -180,13 +245,16 @@ class CastTrack(Track):
         self.plex_track = None
 
         if cast.media_controller.status.images:
-            self.art_url = cast.media_controller.status.images[0].url
-        elif cast.media_controller.status.media_custom_data.get("providerIdentifier") == "com.plexapp.plugins.library":
-            item = config["music"].plex.fetchItem(cast.media_controller.status.media_custom_data["key"])
-            self.plex_track = PlexTrack(item=item)
+            self.art_url = pick_image(cast.media_controller.status.images)
+        # Plex casts carry no art of their own, but without a Plex server
+        # there's nothing to look them up in
+        elif config["music"].plex and cast.media_controller.status.media_custom_data.get("providerIdentifier") == "com.plexapp.plugins.library":
+            resolver = config["music"].resolver
+            item = resolver.plex_item(cast.media_controller.status.media_custom_data["key"])
+            self.plex_track = PlexTrack(item=item, album=resolver.plex_album(item))
             self.art_url = False
         else:
-            self.art_url = meta["images"][1]["url"] if "images" in meta else False
+            self.art_url = pick_image(meta["images"], default=1) if "images" in meta else False
 
     @property
     def timeleft(self):
@@ -195,6 +263,10 @@ class CastTrack(Track):
         else:
             return super().timeleft
 
+    @property
+    def ended(self):
+        return not self.cast.media_controller.status.stream_type_is_live and super().ended
+
     def get_image(self):
         if self.plex_track:
             return self.plex_track.get_image()
@@ -215,7 +287,114 @@ class SpotifyTrack(Track):
             self.year = int(meta["item"]["album"]["release_date"][:4])
         self._album_id = meta["item"]["album"]["id"]
         self._track_id = meta["item"]["id"]
-        self.art_url = meta["item"]["album"]["images"][0]["url"]
+        self.art_url = pick_image(meta["item"]["album"]["images"])
+
+class SpotifyPlayer:
+    """Polls Spotify's currently-playing endpoint with If-None-Match.
+
+    spotipy doesn't expose response headers, so this makes the request
+    itself using spotipy's auth. current() returns (status, meta) where
+    status is "changed" (meta is the new payload), "unchanged" (a 304),
+    "idle" (nothing playing) or "limited" (meta is seconds to back off).
+    """
+
+    def __init__(self, spotify):
+        self.spotify = spotify
+        self.session = requests.Session()
+        self.etag = None
+
+    def current(self):
+        headers = self.spotify._auth_headers()
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+
+        r = self.session.get(self.spotify.prefix + "me/player/currently-playing", headers=headers, timeout=10)
+
+        if r.status_code == 304:
+            return "unchanged", None
+        elif r.status_code == 204:
+            self.etag = None
+            return "idle", None
+        elif r.status_code == 429:
+            return "limited", float(r.headers.get("Retry-After", 60))
+
+        r.raise_for_status()
+        self.etag = r.headers.get("ETag")
+        return "changed", r.json()
+
+    def forget(self):
+        self.etag = None
+
+class PlexListener:
+    """Plex server notifications, so the Plex clients are only polled on a change.
+
+    The server sends a "playing" notification for every session every few
+    seconds while it plays. Only a change of state (playing, paused,
+    stopped) or of track calls on_change; progress is estimated locally
+    anyway. on_change runs on the listener's thread.
+
+    If the websocket can't connect, errors or is closed by the server,
+    alive goes False and on_change is called so the poller stops waiting
+    for notifications that won't come. start() tries again no more often
+    than every retry seconds.
+    """
+
+    def __init__(self, plex, on_change, retry=60.0):
+        self.plex = plex
+        self.on_change = on_change
+        self.retry = retry
+        self.listener = None
+        self.started = 0.0
+        self.failed = False
+        self.sessions = {}
+
+    @property
+    def alive(self):
+        return self.listener is not None and self.listener.is_alive() and not self.failed
+
+    def start(self):
+        if self.alive or time() - self.started < self.retry:
+            return self.alive
+
+        self.started = time()
+        self.failed = False
+        self.sessions = {}
+        self.listener = self.plex.startAlertListener(self._alert, callbackError=self._error)
+        threading.Thread(target=self._watch, args=(self.listener,), daemon=True).start()
+        return True
+
+    def stop(self):
+        listener, self.listener = self.listener, None
+        if listener and listener.is_alive():
+            listener.stop()
+
+    def _alert(self, data):
+        if data.get("type") != "playing":
+            return
+
+        changed = False
+        for session in data.get("PlaySessionStateNotification", []):
+            state = (session.get("state"), session.get("ratingKey"))
+            if self.sessions.get(session.get("sessionKey")) != state:
+                self.sessions[session.get("sessionKey")] = state
+                changed = True
+            if state[0] == "stopped":
+                self.sessions.pop(session.get("sessionKey"), None)
+
+        if changed:
+            self.on_change()
+
+    def _error(self, err):
+        logger.warning(f"Plex notifications: {err}")
+
+    # plexapi only reports errors, not the server closing the socket, so
+    # notice the listener thread ending instead
+    def _watch(self, listener):
+        listener.join()
+        if listener is self.listener:
+            logger.warning("Plex notifications stopped")
+            self.failed = True
+            self.on_change()
 
 class HeosTrack(Track):
     def __init__(self, payload):
@@ -226,51 +405,82 @@ class HeosTrack(Track):
         self.payload = payload
         self.art_url = payload["image_url"]
 
+class NowPlaying:
+    """The track to show and its identity, as of the last published poll."""
+
+    __slots__ = ("track", "album_id", "track_id")
+
+    def __init__(self, track, album_id, track_id):
+        object.__setattr__(self, "track", track)
+        object.__setattr__(self, "album_id", album_id)
+        object.__setattr__(self, "track_id", track_id)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("NowPlaying is read-only")
+
 class Music:
     def __init__(self, devices=None, image_cache=""):
-        self.plex = PlexServer(config["config"]["plex"]["base"], config["config"]["plex"]["token"])
-        self.plex_devices = config["config"]["plex"]["devices"].split(", ")
-        logger.warning("Plex: %s" % ", ".join(self.plex_devices))
-
+        # Only the sources with a config section are set up and polled
+        self.sources = []
+        self.plex = None
         self.chromecasts = None
+        self.heos = None
+
+        if config["config"].has_section("plex"):
+            self.plex = plexapi_server.PlexServer(config["config"]["plex"]["base"], config["config"]["plex"]["token"])
+            self.plex_devices = config["config"]["plex"]["devices"].split(", ")
+            self.sources.append("plex")
+            logger.warning("Plex: %s" % ", ".join(self.plex_devices))
+        self.resolver = Resolver(self.plex)
+
         try:
             devices=config["config"]["chromecast"]["devices"].split(", ")
             self.chromecasts, self.browser = pychromecast.get_listed_chromecasts(friendly_names=devices)
+            self.sources.append("cast")
             logger.warning("Chromecast: %s" % ", ".join(map(lambda x: x.name, self.chromecasts)))
         except KeyError:
             pass
         
-        spotify_cache = CacheFileHandler(cache_path="%s/tokens/%s" % (basepath, config["config"]["spotify"]["username"]))
-        self._spotify = spotipy.Spotify(auth_manager=SpotifyOAuth(
-                                        client_id=config["config"]["spotify"]["spotify_id"],
-                                        client_secret=config["config"]["spotify"]["spotify_secret"],
-                                        cache_handler=spotify_cache,
-                                        redirect_uri="http://localhost:8080/callback",
-                                        show_dialog=True,
-                                        open_browser=False,
-                                        scope="user-library-read,user-read-playback-state"))
-        user = self._spotify.current_user()
-        logger.warning("Spotify: %s [%s]" % (user["display_name"], user["id"]))
-
-        try:
-            self.heos = HeosPlayer(config_file="/home/pi/.heospy/config.json")
-            logger.warning("HEOS: %s" % self.heos.main_player_name)
-
-        except:
-            logging.error("HEOS problem...")
-
-        self.last_album_id = ""
-        self.last_track_id = ""
+        if config["config"].has_section("spotify"):
+            spotify_cache = spotipy_cache.CacheFileHandler(cache_path="%s/tokens/%s" % (basepath, config["config"]["spotify"]["username"]))
+            self._spotify = spotipy.Spotify(auth_manager=spotipy.oauth2.SpotifyOAuth(
+                                            client_id=config["config"]["spotify"]["spotify_id"],
+                                            client_secret=config["config"]["spotify"]["spotify_secret"],
+                                            cache_handler=spotify_cache,
+                                            redirect_uri="http://localhost:8080/callback",
+                                            show_dialog=True,
+                                            open_browser=False,
+                                            scope="user-library-read,user-read-playback-state"))
+            user = self._spotify.current_user()
+            self._spotify_player = SpotifyPlayer(self._spotify)
+            self.sources.append("spotify")
+            logger.warning("Spotify: %s [%s]" % (user["display_name"], user["id"]))
+
+        if config["config"].has_section("heos"):
+            try:
+                self.heos = heospy.HeosPlayer(config_file=config["config"].get("heos", "config_file", fallback="/home/pi/.heospy/config.json"))
+                self.sources.append("heos")
+                logger.warning("HEOS: %s" % self.heos.main_player_name)
+
+            except:
+                logging.error("HEOS problem...")
+
+        self.last_album_id = None
+        self.last_track_id = None
         self.albumArtCached = None
         self.playing = {}
+        self.failed_polls = {}
+        self.now = None
+        self._glyphs = None
+        configuration.subscribe(self.reconfigure)
     
     @property
     def album_id(self):
-        return self.nowplaying().album_id
+        return self.now.album_id
 
     @property
     def track_id(self):
-        return self.nowplaying().track_id
+        return self.now.track_id
 
     @property
     def album(self):
@@ -293,20 +503,48 @@ class Music:
         return self.nowplaying().year
 
     def font(self, size=8):
-        return ImageFont.truetype(config["config"]["fonts"]["music"], size)
+        return ImageFont.truetype(config["settings"].fonts.music, size)
 
     def italic(self, size=8):
-        return ImageFont.truetype(config["config"]["fonts"]["music_italic"], size)
+        return ImageFont.truetype(config["settings"].fonts.music_italic, size)
+
+    def reconfigure(self, old, new):
+        if old.fonts != new.fonts:
+            self._glyphs = None
+
+    def glyphs(self):
+        if not self._glyphs:
+            self._glyphs = GlyphFont(self.font())
+        return self._glyphs
 
     def nowplaying(self):
-        for type in ["heos", "plex", "cast", "spotify"]:
-            if type in self.playing and self.playing[type]:
-                return self.playing[type][0][1]
-        return None
+        now = self.now
+        return now.track if now else None
+
+    # Pollers build their results privately and hand them over here, so
+    # nothing ever sees a source half way through a poll. playing is
+    # replaced rather than changed, and now is worked out once per poll.
+    # The same song can come from more than one source, so changes are
+    # judged on the resolver's identity rather than each source's own ids.
+    def publish(self, source, found):
+        playing = dict(self.playing)
+        playing[source] = tuple(found)
+        track = self.resolver.choose(playing, ["heos", "plex", "cast", "spotify"])
+
+        self.playing = playing
+        self.failed_polls.pop(source, None)
+        self.now = NowPlaying(track, album_key(track), track_key(track)) if track else None
+
+    # A failed poll keeps showing what the source last had, but not past the
+    # end of those tracks or more than a few failures in a row
+    def poll_failed(self, source):
+        self.failed_polls[source] = self.failed_polls.get(source, 0) + 1
+        tracks = [track for _, track in self.playing.get(source, ())]
+        if self.failed_polls[source] >= stale_after or (tracks and all(track.ended for track in tracks)):
+            self.publish(source, [])
 
     def get_playing_plex(self):
-        # Reset playing objects
-        self.playing["plex"] = []
+        found = []
 
         try:
             for client in self.plex.clients():
@@ -317,77 +555,96 @@ class Music:
                 if client.timeline.address == "music.provider.plex.tv":
                     continue
                 try:   
-                    item = self.plex.fetchItem(client.timeline.key)
-                    self.playing["plex"].append((client.title, PlexTrack(item=item, client=client)))
-                except (plexapi.exceptions.NotFound, plexapi.exceptions.BadRequest) as err:
+                    item = self.resolver.plex_item(client.timeline.key)
+                    found.append((client.title, PlexTrack(item=item, client=client, album=self.resolver.plex_album(item))))
+                except (plexapi_exceptions.NotFound, plexapi_exceptions.BadRequest) as err:
                      logger.error(f"I think we have a Tidal track {err}\n{vars(client.timeline)}")
                      continue    
 
-            if self.playing["plex"]:
-                return min(x[1].recheck_in() for x in self.playing["plex"])
+            self.publish("plex", found)
+            if found:
+                return min(x[1].recheck_in() for x in found)
 
         except (TypeError) as err:
             logger.error(f"Plex server TypeError: {err}")
+            self.poll_failed("plex")
             return 30.0
         except requests.exceptions.ConnectionError as err:
             logger.info(f"Plex server ConnectionError: {err}")
+            self.poll_failed("plex")
             return 5.0
         except (AttributeError, requests.exceptions.ReadTimeout) as err:
             logger.error(f"Plex server error: {err}")
+            self.poll_failed("plex")
             return 30.0
 
         return 20.0
 
     def get_playing_spotify(self):
-        self.playing["spotify"] = []
-
         try:
-            meta = self._spotify.current_user_playing_track()
+            status, meta = self._spotify_player.current()
         except (spotipy.exceptions.SpotifyException,
                 spotipy.oauth2.SpotifyOauthError,
+                requests.exceptions.HTTPError,
                 requests.exceptions.ReadTimeout,
                 requests.exceptions.ConnectionError,
                 simplejson.errors.JSONDecodeError) as err:
-            logger.error("Spotify error getting current_user_playing_track: %s" % err)
+            logger.error("Spotify error getting currently playing: %s" % err)
+            self.poll_failed("spotify")
+            self._spotify_player.forget()
             return 60.0
 
-        if meta and meta["is_playing"] and meta["item"]:
-            self.playing["spotify"].append(("Spotify", SpotifyTrack(meta)))
+        if status == "limited":
+            logger.warning("Spotify rate limited for %.0f secs" % meta)
+            return meta
+
+        # Same as last time: keep the track we have rather than rebuilding it
+        if status == "unchanged" and self.playing.get("spotify"):
+            for _, track in self.playing["spotify"]:
+                track.touch()
+            return min(x[1].recheck_in() for x in self.playing["spotify"])
+
+        if status == "changed" and meta and meta["is_playing"] and meta["item"]:
+            self.publish("spotify", [("Spotify", SpotifyTrack(meta))])
             return min(x[1].recheck_in() for x in self.playing["spotify"])
         else:
+            self.publish("spotify", [])
             return 120.0
             
     def get_playing_chromecast(self):
-        self.playing["cast"] = []
+        found = []
 
         for cast in self.chromecasts:
             cast.wait()
             if cast.media_controller.status.player_is_playing:
                 meta = cast.media_controller.status.media_metadata
                 try:
-                    self.playing["cast"].append((cast, CastTrack(cast, meta)))
+                    found.append((cast, CastTrack(cast, meta)))
                 except TypeError as err:
                     logger.warning(f"Plex server TypeError: {err}")
+                    self.poll_failed("cast")
                     return 30.0
 
-        if self.playing["cast"]:
-            return min(x[1].recheck_in() for x in self.playing["cast"])
+        self.publish("cast", found)
+        if found:
+            return min(x[1].recheck_in() for x in found)
 
         return 30.0
 
     def get_playing_heos(self):
-        self.playing["heos"] = []
-
         try:
             result = self.heos.cmd("/player/get_play_state", {"pid": "223731818"})
             if result["heos"]["result"] == "success":
                 if result["heos_message_parsed"]["state"] == "play":
                     result = self.heos.cmd("/player/get_now_playing_media", {"pid": "223731818"})
                     if result["heos"]["result"] == "success":
-                        self.playing["heos"].append(("Heos", HeosTrack(result["payload"])))
-                        return min(x[1].recheck_in() for x in self.playing["heos"])
+                        track = HeosTrack(result["payload"])
+                        self.publish("heos", [("Heos", track)])
+                        return track.recheck_in()
+            self.publish("heos", [])
         except (KeyError, BrokenPipeError, TimeoutError, ConnectionResetError) as err:
             logger.error(err)
+            self.poll_failed("heos")
             
         return 120.0
 
@@ -409,19 +666,10 @@ class Music:
 
     def album_image(self):
         if not self.albumArtCached:
-            self.albumArtCached = self.image
+            self.albumArtCached = self.resolver.album_art(self.nowplaying())
 
         return self.albumArtCached
 
-    def canvas(self):
-        canvas = Image.new('RGBA', (64, 64), (0,0,0))
-        canvas.paste(self.album_image(), (0, 0))
-
-        if config["weather"].steamy() or config["weather"].icy() or not config["frame"].square:
-            canvas.alpha_composite(config["weather"].extreme())
-
-        return canvas
-
     def layout_text(self):
         text = self.artist + "\n"
         text += f'"{self.track}"' + "\n"
@@ -431,10 +679,9 @@ class Music:
             else:
                 text += self.album
 
-        (l, t, r, b) = ImageDraw.Draw(Image.new('RGBA', (1, 1))).multiline_textbbox((0, -1), text, font=self.font(), spacing=0)
+        (l, t, r, b) = self.glyphs().textbbox((0, -1), text)
 
         image = Image.new('RGBA', (r, b + 1), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(image)
-        draw.multiline_text((1, 1), text, fill=(0,0,0), font=self.font(), spacing=0)
-        draw.multiline_text((0, 0), text, fill=(255, 255, 255), font=self.font(), spacing=0)
+        self.glyphs().text(image, (1, 1), text, (0,0,0))
+        self.glyphs().text(image, (0, 0), text, (255, 255, 255))
         return image
\ No newline at end of file
@@ -0,0 +1,85 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+class Profiler:
+    """cProfile and tracemalloc captures, started from signals.
+
+    SIGUSR1 profiles the event loop for a few seconds and writes both the
+    raw .prof file and a text summary. SIGUSR2 takes a tracemalloc
+    snapshot; the first one starts tracing, and each one after that writes
+    the biggest growth since the previous snapshot. Tracing stops again
+    after diffs reports, so nothing stays hooked into the process once a
+    capture is done.
+    """
+
+    def __init__(self, loop, report_dir, seconds=30.0, top=25, diffs=3):
+        self.loop = loop
+        self.report_dir = report_dir
+        self.seconds = seconds
+        self.top = top
+        self.diffs = diffs
+        self.written = 0
+        self.profile = None
+        self.snapshot = None
+
+    def install(self):
+        self.loop.add_signal_handler(signal.SIGUSR1, self.start_profile)
+        self.loop.add_signal_handler(signal.SIGUSR2, self.take_snapshot)
+
+    def _path(self, kind, ext):
+        os.makedirs(self.report_dir, exist_ok=True)
+        return "%s/%s-%s.%s" % (self.report_dir, kind, time.strftime("%Y%m%d-%H%M%S"), ext)
+
+    def start_profile(self):
+        if self.profile:
+            logger.warning("Already profiling")
+            return
+        logger.warning("Profiling for %.0f secs" % self.seconds)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.loop.call_later(self.seconds, self.stop_profile)
+
+    def stop_profile(self):
+        self.profile.disable()
+        path = self._path("profile", "prof")
+        self.profile.dump_stats(path)
+
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(self.top)
+        with open(path[:-len(".prof")] + ".txt", "w") as f:
+            f.write(summary.getvalue())
+
+        self.profile = None
+        logger.warning("Wrote %s" % path)
+
+    def take_snapshot(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self.snapshot = tracemalloc.take_snapshot()
+            self.written = 0
+            logger.warning("Started tracemalloc, send SIGUSR2 again to see what grew")
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        path = self._path("memory", "txt")
+        with open(path, "w") as f:
+            current, peak = tracemalloc.get_traced_memory()
+            f.write("Traced: %d KiB now, %d KiB peak\n\n" % (current / 1024, peak / 1024))
+            for stat in snapshot.compare_to(self.snapshot, "lineno")[:self.top]:
+                f.write("%s\n" % stat)
+        self.snapshot = snapshot
+        self.written += 1
+        logger.warning("Wrote %s" % path)
+
+        if self.written >= self.diffs:
+            tracemalloc.stop()
+            self.snapshot = None
+            logger.warning("Stopped tracemalloc after %d reports" % self.written)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Thin receiver for frames streamed by spotify-display.py: it only puts
+# what arrives on the panel. Frames come already gamma corrected and cut to
+# size, so there's nothing to configure but the panel itself.
+#
+#   receive-frames.py [--port 7000] [--tcp] [--rows 64] [--cols 64]
+#                     [--brightness 50] [--emulate] [--snapshot frame.png]
+#
+# --emulate skips the matrix and just counts frames (saving the latest to
+# --snapshot every few seconds), to try it all out on one machine.
+
+import argparse
+import logging
+import time
+from streaming import Receiver
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description="Show frames streamed from spotify-display.py")
+parser.add_argument("--port", type=int, default=7000)
+parser.add_argument("--tcp", action="store_true", help="listen on TCP instead of UDP")
+parser.add_argument("--rows", type=int, default=64)
+parser.add_argument("--cols", type=int, default=64)
+parser.add_argument("--brightness", type=int, default=50)
+parser.add_argument("--hardware-mapping", default="adafruit-hat-pwm")
+parser.add_argument("--emulate", action="store_true", help="don't drive a matrix")
+parser.add_argument("--snapshot", help="with --emulate, save the latest frame here")
+args = parser.parse_args()
+
+if not args.emulate:
+    from rgbmatrix import RGBMatrix, RGBMatrixOptions
+
+    options = RGBMatrixOptions()
+    options.brightness = args.brightness
+    options.hardware_mapping = args.hardware_mapping
+    options.rows = args.rows
+    options.cols = args.cols
+    matrix = RGBMatrix(options=options)
+    offscreen_canvas = matrix.CreateFrameCanvas()
+
+receiver = Receiver(port=args.port, transport="tcp" if args.tcp else "udp")
+logger.warning("Listening on %s port %d" % ("TCP" if args.tcp else "UDP", args.port))
+
+shown = 0
+t0 = time.time()
+for seq, image, (padding_left, padding_top) in receiver.frames():
+    if args.emulate:
+        if args.snapshot and time.time() - t0 > 5.0:
+            image.save(args.snapshot)
+    else:
+        offscreen_canvas.SetImage(image, padding_left, padding_top)
+        offscreen_canvas = matrix.SwapOnVSync(offscreen_canvas)
+    shown += 1
+
+    if time.time() - t0 > 5.0:
+        logger.warning("Received FPS: %0.2f (frame %d)" % (shown / (time.time() - t0), seq))
+        shown = 0
+        t0 = time.time()
@@ -0,0 +1,127 @@
+import logging
+import struct
+import time
+import zlib
+import numpy
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# A recording is a magic line followed by one record per frame:
+#
+#   kind     B   "K" keyframe or "D" delta
+#   night    B   whether the frame was dimmed for night
+#   at       d   seconds since recording started
+#   render   f   seconds spent building the frame, 0 if the caller didn't say
+#   width    H
+#   height   H
+#   length   I   bytes of payload that follow
+#
+# A keyframe's payload is the zlib-compressed RGB frame. A delta is the XOR
+# with the previous frame, stored as (skip, count) runs of changed bytes,
+# which is tiny for a mostly static 64x64 display.
+
+magic = b"FRAMES1\n"
+header = struct.Struct("<BBdfHHI")
+run = struct.Struct("<IH")
+keyframe = ord("K")
+delta = ord("D")
+
+# Unchanged bytes closer together than this are cheaper to store than to
+# start a new run for
+run_gap = run.size
+
+def encode_runs(changes):
+    changed = numpy.flatnonzero(changes)
+    if not len(changed):
+        return b""
+
+    breaks = numpy.flatnonzero(numpy.diff(changed) > run_gap) + 1
+    starts = changed[numpy.r_[0, breaks]]
+    ends = changed[numpy.r_[breaks - 1, len(changed) - 1]] + 1
+
+    data = bytearray()
+    position = 0
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        # Runs are limited to what fits in the count field
+        while start < end:
+            count = min(end - start, 0xffff)
+            data += run.pack(start - position, count)
+            data += changes[start:start + count].tobytes()
+            position = start = start + count
+    return bytes(data)
+
+def apply_runs(data, pixels):
+    position = 0
+    offset = 0
+    while offset < len(data):
+        skip, count = run.unpack_from(data, offset)
+        offset += run.size
+        position += skip
+        pixels[position:position + count] ^= numpy.frombuffer(data, numpy.uint8, count, offset)
+        offset += count
+        position += count
+
+class Recorder:
+    """Writes every frame given to Frame.swap into a recording.
+
+    A keyframe starts the file and every keyframe_every frames after that,
+    or whenever the frame size changes; everything in between is a delta.
+    """
+
+    def __init__(self, path, keyframe_every=600):
+        self.path = path
+        self.keyframe_every = keyframe_every
+        self.file = open(path, "wb")
+        self.file.write(magic)
+        self.previous = None
+        self.count = 0
+        self.t0 = time.monotonic()
+
+    def write(self, canvas, night, render):
+        if canvas.mode != "RGB":
+            canvas = canvas.convert("RGB")
+        pixels = numpy.asarray(canvas).reshape(-1)
+
+        if self.previous is None or self.previous.shape != pixels.shape or self.count % self.keyframe_every == 0:
+            kind, payload = keyframe, zlib.compress(pixels.tobytes(), 1)
+            self.previous = pixels.copy()
+        else:
+            changes = numpy.bitwise_xor(pixels, self.previous)
+            kind, payload = delta, encode_runs(changes)
+            numpy.copyto(self.previous, pixels)
+
+        self.file.write(header.pack(kind, night, time.monotonic() - self.t0, render, canvas.width, canvas.height, len(payload)))
+        self.file.write(payload)
+        self.count += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            logger.warning("Recorded %d frames to %s" % (self.count, self.path))
+
+def frames(path):
+    """Yield (at, render, night, image) for each frame in a recording."""
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("%s isn't a frame recording" % path)
+
+        pixels = None
+        while True:
+            raw = f.read(header.size)
+            if len(raw) < header.size:
+                return
+            kind, night, at, render, width, height, length = header.unpack(raw)
+            payload = f.read(length)
+            if len(payload) < length:
+                logger.warning("%s ends part way through a frame" % path)
+                return
+
+            if kind == keyframe:
+                pixels = numpy.frombuffer(zlib.decompress(payload), numpy.uint8).copy()
+            elif pixels is None or len(pixels) != width * height * 3:
+                raise ValueError("%s has a delta without a keyframe" % path)
+            else:
+                apply_runs(payload, pixels)
+
+            yield at, render, bool(night), Image.frombytes("RGB", (width, height), pixels.tobytes())
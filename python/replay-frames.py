@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Play a recording made with [debug] record = <path> through the same Frame
+# output path the display uses, at the recorded pace or, with --fast, as
+# quickly as it'll go.
+#
+#   replay-frames.py <recording> [config] [--fast]
+
+import logging
+import os
+import sys
+import time
+import recording
+from frame import Frame, RingFrame
+from config import config
+import config as configuration
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+basepath = os.path.dirname(sys.argv[0])
+if basepath == "":
+    basepath = "."
+
+fast = "--fast" in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != "--fast"]
+
+if not args:
+    sys.exit("usage: replay-frames.py <recording> [config] [--fast]")
+
+path = args[0]
+if len(args) > 1:
+    configfile = args[1]
+else:
+    configfile = "%s/local.config" % basepath
+
+configuration.load(configfile)
+if config["settings"].matrix.multiprocess:
+    frame = RingFrame()
+else:
+    frame = Frame()
+
+count = 0
+rendered = 0.0
+output = 0.0
+start = time.monotonic()
+first = None
+
+for at, render, night, image in recording.frames(path):
+    if first is None:
+        first = at
+    if not fast:
+        delay = (at - first) - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+    t0 = time.monotonic()
+    frame.swap(image, night=night)
+    output += time.monotonic() - t0
+    rendered += render
+    count += 1
+
+elapsed = time.monotonic() - start
+if count:
+    logger.warning("%d frames in %0.2f secs (%0.1f fps), output %0.2f ms/frame, recorded render %0.2f ms/frame" %
+        (count, elapsed, count / elapsed, output / count * 1000, rendered / count * 1000))
@@ -1,24 +1,31 @@
 #!/usr/bin/env python3
 
+import time
+started = time.monotonic()
+
 from hsluv import hsluv_to_rgb, hpluv_to_rgb
 import asyncio
-import configparser
+import signal
 from datetime import datetime
 import logging
-import time
 import sys
 import os
 import os.path
-from rgbmatrix import RGBMatrix, RGBMatrixOptions
-from PIL import Image, ImageEnhance, ImageFont, ImageDraw
+from PIL import Image, ImageFont, ImageDraw
 import weather as weatherimport
 import music as musicimport
 from music import TrackError
+from transitions import Transition
+from compositor import Compositor
+from frame import Frame, RingFrame, StreamFrame
+from profiling import Profiler
+import lazy
 from config import config
-from colorsys import rgb_to_hsv, hsv_to_rgb
+import config as configuration
+from functools import lru_cache
+from collections import deque
 import numpy
 
-config["config"] = configparser.ConfigParser()
 basepath = os.path.dirname(sys.argv[0])
 if basepath == "":
     basepath = "."
@@ -28,7 +35,7 @@ if len(sys.argv) > 1:
 else:
     configfile = "%s/local.config" % basepath
 
-config["config"].read(configfile)
+configuration.load(configfile)
 
 try:
     devices = config["config"]["chromecast"]["devices"].split(", ")
@@ -40,8 +47,12 @@ image_cache = "%s/imagecache" % (basepath)
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
   
+@lru_cache(maxsize=None)
+def truetype(path, size):
+    return ImageFont.truetype(path, size)
+
 def font(size):
-    return ImageFont.truetype(config["config"]["fonts"]["time"], size)
+    return truetype(config["settings"].fonts.time, size)
 
 def hpluv2rgb(h,s,v):
     return tuple(int(i * 256) for i in hpluv_to_rgb([h, s , v]))
@@ -49,79 +60,37 @@ def hpluv2rgb(h,s,v):
 def hsluv2rgb(h,s,v):
     return tuple(int(i * 256) for i in hsluv_to_rgb([h, s , v]))
 
-class Frame:
-    def __init__(self):
-        self.options = RGBMatrixOptions()
-        self.options.brightness = int(config["config"]["matrix"]["brightness"])
-        self.options.hardware_mapping = "adafruit-hat-pwm"
-        self.options.rows = int(config["config"]["matrix"]["height"])
-        self.options.cols = int(config["config"]["matrix"]["width"])
-        self.gamma = lambda value : round(pow(value / 255.0, float(config["config"]["matrix"]["gamma"])) * 255.0)
-        
-        self.count = 0
-        self.t0 = time.time()
-
-        self.matrix = RGBMatrix(options=self.options)
-        self.offscreen_canvas = self.matrix.CreateFrameCanvas()
-        self.width = self.options.cols - int(config["config"]["matrix"]["padding_left"])
-        self.height = self.options.rows - int(config["config"]["matrix"]["padding_top"])
-    
-    @property
-    def square(self):
-        return self.options.cols == self.options.rows
-
-    def swap(self, canvas):
-        self.count += 1
-        padding_left = int(config["config"]["matrix"]["padding_left"])
-        padding_top = int(config["config"]["matrix"]["padding_top"])
-
-        canvas = Image.eval(canvas, self.gamma)
-
-        if config["weather"].night:
-            canvas = ImageEnhance.Brightness(canvas).enhance(0.5)
-
-        self.offscreen_canvas.SetImage(canvas, padding_left, padding_top)
-        self.offscreen_canvas = self.matrix.SwapOnVSync(self.offscreen_canvas)
-
-    def fps(self):
-        t1 = time.time()
-        logger.warning("FPS: %0.2f (%d in %0.2f secs)" % (self.count / (t1 - self.t0), self.count, (t1 - self.t0)))
-        self.t0 = t1
-        self.count = 0
-
-def brighten(rgb):
-    r, g, b = rgb
-    h, s, v = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
-    v = min(1.0, v * 1.5)
-    r, g, b = hsv_to_rgb(h, s, v)
-    return (int(r * 255), int(g * 255), int(b * 255))
-
 def getsize(bbox):
     return (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
-def small_clock():
+# The clocks only change once a minute, so keep the last few renders around
+# and hand back the same image until the time or color changes.
+@lru_cache(maxsize=4)
+def render_small_clock(hour, minute, color):
     timeImg = Image.new('RGBA', (32, 32), (0,0,0,0))
     draw = ImageDraw.Draw(timeImg)
-    color = brighten(config["weather"].temp_color())
     draw.fontmode = None
     
-    t_width, t_height = getsize(font(18).getbbox(datetime.now().strftime("%I")))
-    draw.text((17 - (t_width >> 1), 5 - (t_height >> 1) + 1), datetime.now().strftime("%I"), (0,0,0), font=font(18))
-    draw.text((16 - (t_width >> 1), 4 - (t_height >> 1) + 1), datetime.now().strftime("%I"), color, font=font(18))
+    t_width, t_height = getsize(font(18).getbbox(hour))
+    draw.text((17 - (t_width >> 1), 5 - (t_height >> 1) + 1), hour, (0,0,0), font=font(18))
+    draw.text((16 - (t_width >> 1), 4 - (t_height >> 1) + 1), hour, color, font=font(18))
 
-    t_width, t_height = getsize(font(18).getbbox(datetime.now().strftime("%M")))
-    draw.text((17 - (t_width >> 1), 20 - (t_height >> 1) + 1), datetime.now().strftime("%M"), (0,0,0), font=font(18))
-    draw.text((16 - (t_width >> 1), 19 - (t_height >> 1) + 1), datetime.now().strftime("%M"), color, font=font(18))
+    t_width, t_height = getsize(font(18).getbbox(minute))
+    draw.text((17 - (t_width >> 1), 20 - (t_height >> 1) + 1), minute, (0,0,0), font=font(18))
+    draw.text((16 - (t_width >> 1), 19 - (t_height >> 1) + 1), minute, color, font=font(18))
 
     return timeImg
 
-def clock():
-    mytime=datetime.now().strftime("%-I:%M")
+def small_clock():
+    now = datetime.now()
+    return render_small_clock(now.strftime("%I"), now.strftime("%M"), config["weather"].snapshot.bright_color)
 
+@lru_cache(maxsize=4)
+def render_clock(mytime, color):
     timeImg = Image.new('RGBA', (64, 30), (0,0,0,0))
 
     draw = ImageDraw.Draw(timeImg)
-    # draw.rectangle([(0,0), (64,30)], fill=config["weather"].temp_color())
+    # draw.rectangle([(0,0), (64,30)], fill=config["weather"].snapshot.temp_color)
 
     t_width = getsize(font(18).getbbox(mytime))[0]
     t_height = getsize(font(18).getbbox(mytime))[1]
@@ -130,10 +99,17 @@ def clock():
     draw.text((32 - (t_width >> 1) + 2, 10 - (t_height >> 1) + 2),
             mytime, (0,0,0,128), font=font(18))
     draw.text((32 - (t_width >> 1), 10 - (t_height >> 1)),
-            mytime, brighten(config["weather"].temp_color()), font=font(18))
+            mytime, color, font=font(18))
 
     return timeImg
 
+def clock():
+    return render_clock(datetime.now().strftime("%-I:%M"), config["weather"].snapshot.bright_color)
+
+# Longest oscillator we look for, and how long to let one run before nudging
+conway_max_period = 16
+conway_replay_secs = 5.0
+
 def conway(dimensions = (64,64)):
     w, h = dimensions
     gen = 0
@@ -146,18 +122,53 @@ def conway(dimensions = (64,64)):
     bitmap = [ numpy.zeros((w * h * 4), dtype=numpy.uint8),
                numpy.zeros((w * h * 4), dtype=numpy.uint8) ]
 
-    for x in range(w * h):
-        if numpy.random.randint(0, 5) == 1:
-            bitmap[gen][x * 4]     = conway_color[int(time.time() - 5) % color_cycle][0]
-            bitmap[gen][x * 4 + 1] = conway_color[int(time.time() - 5) % color_cycle][1]
-            bitmap[gen][x * 4 + 2] = conway_color[int(time.time() - 5) % color_cycle][2]
-            bitmap[gen][x * 4 + 3] = 255
+    def seed(board):
+        color = conway_color[int(time.time() - 5) % color_cycle]
+        cells = board.reshape(w * h, 4)
+        alive = numpy.random.randint(0, 5, size=w * h) == 1
+        cells[:, 3] = 0
+        cells[alive] = color + (255,)
+
+    def line(board, color, row=None, column=None):
+        cells = board.reshape(h, w, 4)
+        if row is not None:
+            cells[row, :] = color + (255,)
+        else:
+            cells[:, column] = color + (255,)
+
+    seed(bitmap[gen])
 
     images = [  Image.frombuffer("RGBA", (w, h), bitmap[0]),
                 Image.frombuffer("RGBA", (w, h), bitmap[1]) ]        
 
+    # Recent generations, keyed by a hash of which cells are alive. When the
+    # board repeats itself we replay the cycle from here instead of
+    # computing it, then shake things up.
+    history = deque(maxlen=conway_max_period)
+    replay = None
+    replay_pos = 0
+    replay_until = 0
 
     while True:
+        if replay:
+            gen ^= 1
+            numpy.copyto(bitmap[gen], replay[replay_pos % len(replay)])
+            replay_pos += 1
+
+            # Stagnant long enough: drop a line across the board, or start
+            # over if everything has died.
+            if time.monotonic() >= replay_until:
+                replay = None
+                if not bitmap[gen][3::4].any():
+                    seed(bitmap[gen])
+                elif numpy.random.randint(0, 2) == 1:
+                    line(bitmap[gen], conway_color[int(time.time() + 5) % color_cycle], row=numpy.random.randint(0, h))
+                else:
+                    line(bitmap[gen], conway_color[int(time.time() + 10) % color_cycle], column=numpy.random.randint(0, w))
+
+            yield images[gen]
+            continue
+
         i_color = conway_color[int(time.time()) % color_cycle]
 
         for z in range(w * h):
@@ -189,31 +200,42 @@ def conway(dimensions = (64,64)):
 
         gen ^= 1
 
-        if numpy.random.randint(0, 50) == 1:
-            i_color = conway_color[int(time.time() + 5) % color_cycle]
-            z = numpy.random.randint(0, h)
-            for x in range(w):
-                bitmap[gen][(z * w + x) * 4]     = i_color[0]
-                bitmap[gen][(z * w + x) * 4 + 1] = i_color[1]
-                bitmap[gen][(z * w + x) * 4 + 2] = i_color[2]
-                bitmap[gen][(z * w + x) * 4 + 3] = 255
-        elif numpy.random.randint(0, 50) == 1:
-            i_color = conway_color[int(time.time() + 10) % color_cycle]
-            z = numpy.random.randint(0, w)
-            for y in range(h):
-                bitmap[gen][(z + y * w) * 4]     = i_color[0]
-                bitmap[gen][(z + y * w) * 4 + 1] = i_color[1]
-                bitmap[gen][(z + y * w) * 4 + 2] = i_color[2]
-                bitmap[gen][(z + y * w) * 4 + 3] = 255
+        key = hash(bitmap[gen][3::4].tobytes())
+        for n, (seen, board) in enumerate(history):
+            if seen == key:
+                # The current board is history[n], so the cycle carries on
+                # from the one after it.
+                replay = [board for seen, board in list(history)[n:]]
+                replay_pos = 1
+                replay_until = time.monotonic() + conway_replay_secs
+                history.clear()
+                logger.info("Conway cycle with period %d" % len(replay))
+                break
+        else:
+            history.append((key, bitmap[gen].copy()))
 
         yield images[gen]        
 
+def layers():
+    compositor = Compositor(size=(64, 64))
+    # Now playing
+    compositor.add("cover", z=0)
+    compositor.add("extreme", z=1)
+    compositor.add("text", z=2)
+    # Nothing playing
+    compositor.add("weather", z=0)
+    compositor.add("conway", position=(0, 34), z=1)
+    compositor.add("clock", position=(0, 34), z=2)
+    compositor.add("small_clock", position=(32, 0), z=2)
+    return compositor
+
 async def main():
     weather = config["weather"]
     music = config["music"]
     frame = config["frame"]
+    scene = layers()
     txtImg = None
-    canvas = None
+    showing = ()
 
     while True:
         # We have a playing track.
@@ -222,65 +244,75 @@ async def main():
             if music.new_song():
                 logger.warning("now playing song: %s (%s)" % (music.nowplaying().track, type(music.nowplaying())))
                 txtImg = music.layout_text()
+                scene["text"].set(txtImg, (0, frame.height - txtImg.height))
 
             # Fade in new album covers
             if music.new_album():
                 try:
-                    canvas = music.canvas()
+                    scene["cover"].set(music.album_image().convert('RGBA'))
+                    scene["extreme"].set(weather.extreme())
+                    extreme = weather.snapshot.steamy or weather.snapshot.icy or not config["frame"].square
                 except TrackError as err:
                     logger.warning(err)
-                    canvas = Image.new('RGBA', (64, 64), (0, 0, 0))
-                    canvas.paste(weather.weather_summary(), (0, 0))
-                    canvas.paste(weather.icon(), (32, 0))
-                    
-                    
+                    cover = Image.new('RGBA', (64, 64), (0, 0, 0))
+                    cover.paste(weather.weather_summary(), (0, 0))
+                    cover.paste(weather.icon(), (32, 0))
+                    scene["cover"].set(cover)
+                    extreme = False
+
+                showing = ("cover", "text", "extreme") if extreme else ("cover", "text")
+                scene.only(*showing)
+                if txtImg.width >= frame.width:
+                    scene["text"].hide()
+
                 logger.warning("now playing album: %s - %s" % (music.nowplaying().artist, music.nowplaying().album))
-                for x in range(127):
-                    bg = canvas.copy()
-                    if txtImg.width < frame.width:
-                        bg.alpha_composite(txtImg, dest=(0, frame.height - txtImg.height))
-                    frame.swap(ImageEnhance.Brightness(bg).enhance(x * 2 / 255.0).convert('RGB'))
-                    time.sleep(0.01) # Don't release thread until scroll is done
+                # The compositor draws in place, so hold on to what's on screen first
+                previous = frame.last.copy() if frame.last is not None else None
+                transition = Transition(previous, scene.render(), kind=config["settings"].matrix.transition)
+                while not transition.done:
+                    t0 = time.monotonic()
+                    frame.swap(transition.frame(), started=t0)
+                    time.sleep(0.01) # Don't release thread until the transition is done
 
                 await asyncio.sleep(0)
 
+            scene.only(*showing)
+
             # If either line of text is longer than the display, scroll
             if txtImg.width >= frame.width:
                 for x in range(txtImg.width + 10 + frame.width):
-                    bg = canvas.copy()
-                    bg.alpha_composite(txtImg, dest=(frame.width - x, frame.height - txtImg.height))
-                    frame.swap(bg.convert('RGB'))
+                    t0 = time.monotonic()
+                    scene["text"].move((frame.width - x, frame.height - txtImg.height))
+                    frame.swap(scene.render(), scene.version, started=t0)
                     time.sleep(0.01) # Don't release thread until scroll is done
                 await asyncio.sleep(1.0)
             else:
-                bg = canvas.copy()
-                bg.alpha_composite(txtImg, dest=(0, frame.height - txtImg.height))
-                frame.swap(bg.convert('RGB'))
+                t0 = time.monotonic()
+                scene["text"].move((0, frame.height - txtImg.height))
+                frame.swap(scene.render(), scene.version, started=t0)
 
         # Nothing is playing
         else:
-            weather_canvas = weather.w_canvas.copy()
+            t0 = time.monotonic()
+            scene["weather"].set(weather.w_canvas)
             # On large screens, show a small clock and the planets 
             # or a big clock and conway's game of life if cloudy
             # or daytime
             if config["frame"].square:
-                if weather.night:
-                    if weather._now["clouds"] > 0:
-                        weather_canvas.alpha_composite(next(conway_gen), (0, 34))
-                        weather_canvas.alpha_composite(clock(), dest=(0,34))
-                    else:
-                        # p_canvas = weather.p_canvas.crop((t, 0, t + 128, 64)).resize((64, 32), resample=Image.Resampling.BILINEAR)
-                        weather_canvas.alpha_composite(next(conway_gen), (0, 34))
-                        # weather_canvas.alpha_composite(p_canvas, dest=(0,32))
-                        weather_canvas.alpha_composite(small_clock(), dest=(32, 0))
+                scene["conway"].set(next(conway_gen))
+                scene["conway"].touch()
+                if weather.night and weather.snapshot.clouds == 0:
+                    scene["small_clock"].set(small_clock())
+                    scene.only("weather", "conway", "small_clock")
                 else:
-                    weather_canvas.alpha_composite(next(conway_gen), (0, 34))
-                    weather_canvas.alpha_composite(clock(), dest=(0,34))
+                    scene["clock"].set(clock())
+                    scene.only("weather", "conway", "clock")
             # On small screens, show a small clock over the weather icon
             else:
-                weather_canvas.alpha_composite(small_clock(), dest=(32,0))
-            
-            frame.swap(weather_canvas.convert('RGB'))
+                scene["small_clock"].set(small_clock())
+                scene.only("weather", "small_clock")
+
+            frame.swap(scene.render(), scene.version, started=t0)
 
         await asyncio.sleep(0)
 
@@ -299,10 +331,26 @@ async def update_chromecast():
         delay = config["music"].get_playing_chromecast()
         await asyncio.sleep(delay)
 
+# How often to check on Plex anyway while its notifications are coming in
+plex_idle_poll = 120.0
+
 async def update_plex():
+    # Poll when the server says something changed, and only rarely otherwise.
+    # Without notifications, fall back to polling on the track's schedule.
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    listener = musicimport.PlexListener(config["music"].plex, lambda: loop.call_soon_threadsafe(changed.set))
+
     while True:
+        changed.clear()
         delay = config["music"].get_playing_plex()
-        await asyncio.sleep(delay)
+        if listener.start():
+            delay = plex_idle_poll
+
+        try:
+            await asyncio.wait_for(changed.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
 
 async def update_heos():
     while True:
@@ -314,26 +362,66 @@ async def update_spotify():
         delay = config["music"].get_playing_spotify()
         await asyncio.sleep(delay)
 
+async def watch_settings():
+    # Reload on SIGHUP, or when the file changes underneath us
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, configuration.reload)
+    while True:
+        if configuration.changed():
+            configuration.reload()
+        await asyncio.sleep(5.0)
+
+def clear_clocks(old, new):
+    render_clock.cache_clear()
+    render_small_clock.cache_clear()
+
+# What startup and each backend's first use cost, once they've all had a go
+async def import_report():
+    lazy.report(startup=time.monotonic() - started)
+    await asyncio.sleep(60.0)
+    lazy.report()
+
 async def fps_display():
     while True:
         config["frame"].fps()
         await asyncio.sleep(60.0)
 
 async def metamain():
+    # kill -USR1 to profile, kill -USR2 to snapshot memory (tracing stops
+    # again after [debug] memory_diffs reports)
+    Profiler(asyncio.get_running_loop(), "%s/profiles" % basepath,
+             seconds=config["config"].getfloat("debug", "profile_secs", fallback=30.0),
+             diffs=config["config"].getint("debug", "memory_diffs", fallback=3)).install()
+
+    pollers = { "plex": update_plex, "spotify": update_spotify, "cast": update_chromecast, "heos": update_heos }
+
     await asyncio.gather(
         update_weather(),
         update_weather_summary(),
-        update_plex(),
-        update_spotify(),
-        update_chromecast(),
-        update_heos(),
+        *[pollers[source]() for source in config["music"].sources],
         fps_display(),
+        import_report(),
+        watch_settings(),
         main()
     )
 
-config["frame"] = Frame()
+# Stream to [display] receivers, or render and display in separate
+# processes if asked to
+if config["settings"].displays:
+    config["frame"] = StreamFrame()
+elif config["settings"].matrix.multiprocess:
+    config["frame"] = RingFrame()
+else:
+    config["frame"] = Frame()
+
+# Record everything shown, for replay-frames.py
+record = config["config"].get("debug", "record", fallback=None)
+if record:
+    config["frame"].record(record)
+
 config["weather"] = weatherimport.Weather(api_key=config["config"]["openweathermap"]["api_key"], image_cache=image_cache)
 config["music"] = musicimport.Music(devices=devices, image_cache=image_cache)
 
+configuration.subscribe(clear_clocks)
+
 conway_gen = conway((64, 34))
 asyncio.run(metamain())
\ No newline at end of file
@@ -1,5 +1,4 @@
 import spotipy
-import re
 from spotipy.oauth2 import SpotifyOAuth
 from spotipy.cache_handler import CacheFileHandler
 import simplejson
@@ -11,6 +10,8 @@ from plexapi.server import PlexServer
 from plexapi.myplex import MyPlexDevice
 import plexapi
 import time
+from concurrent.futures import ThreadPoolExecutor
+from matcher import TrackMatcher, normalize_track
 
 
 config = configparser.ConfigParser()
@@ -18,8 +19,12 @@ basepath = os.path.dirname(sys.argv[0])
 if basepath == "":
     basepath = "."
 
-if len(sys.argv) > 1:
-    configfile = sys.argv[1]
+# --full ignores the saved checkpoint and walks the whole library again
+full_sync = "--full" in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != "--full"]
+
+if len(args) > 0:
+    configfile = args[0]
 else:
     configfile = "%s/local.config" % basepath
 
@@ -37,77 +42,160 @@ spotify = spotipy.Spotify(auth_manager=SpotifyOAuth(
 user = spotify.current_user()
 # print("Now Playing for %s [%s]" % (user["display_name"], user["id"]))
 playlist_name = f"Liked {time.strftime('%Y-%m-%d')}"
-spotify_playlist = spotify.user_playlist_create(user["id"], playlist_name, public=False)
-spotify_playlist_id = spotify_playlist["id"]
 
 plex = PlexServer(config["plex"]["base"], config["plex"]["token"])
 music = plex.library.section("Music")
-plex_playlist = None
-
-def compare(string1, string2):
-    if string1 and string2:
-        return normalize_string(string1) == normalize_string(string2)
-    else:
-        return False
-
-def normalize_track(title):
-    return re.sub(r' - (\d+ )?Remaster(ed)?( \d+)?', '', title).strip()
 
-def normalize_string(title):
-    return re.sub(r'[^a-z0-9 ]', '', title.lower().removeprefix("the ").strip())
+# Spotify caps saved-track pages at 50 items and playlist additions at 100 URIs.
+page_size = 50
+spotify_batch = 100
+plex_batch = 500
+page_workers = 8
+
+# Last processed added_at plus Spotify track id -> Plex ratingKey (None when
+# there was no match on Plex).
+state_file = "%s/tokens/likes-state-%s.json" % (basepath, config["spotify"]["username"])
+
+def load_state():
+    try:
+        with open(state_file) as f:
+            return simplejson.load(f)
+    except (OSError, simplejson.errors.JSONDecodeError):
+        return { "last_added_at": None, "matches": {} }
+
+def save_state(state):
+    tmp = state_file + ".tmp"
+    with open(tmp, "w") as f:
+        simplejson.dump(state, f)
+    os.replace(tmp, state_file)
+
+def saved_tracks(since=None):
+    # Saved tracks come back newest first, so an incremental run pages in
+    # order and stops at the first like we've already processed.
+    if since:
+        saved = spotify.current_user_saved_tracks(limit=page_size)
+        while True:
+            for track in saved["items"]:
+                if track["added_at"] <= since:
+                    return
+                yield track
+            if saved["next"]:
+                saved = spotify.next(saved)
+            else:
+                return
+
+    first = spotify.current_user_saved_tracks(limit=page_size)
+    yield from first["items"]
+
+    # Once we know the total, fetch the remaining pages in parallel by offset.
+    offsets = range(page_size, first["total"], page_size)
+    with ThreadPoolExecutor(max_workers=page_workers) as pool:
+        pages = pool.map(lambda offset: spotify.current_user_saved_tracks(limit=page_size, offset=offset), offsets)
+        for page in pages:
+            yield from page["items"]
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def flush_spotify(uris):
+    if not uris:
+        return
+    spotify_playlist = spotify.user_playlist_create(user["id"], playlist_name, public=False)
+    for batch in chunks(uris, spotify_batch):
+        spotify.user_playlist_add_tracks(user["id"], spotify_playlist["id"], batch)
+
+def flush_plex(items):
+    if not items:
+        return
+    plex_playlist = music.createPlaylist(playlist_name, items=items[:plex_batch])
+    for batch in chunks(items[plex_batch:], plex_batch):
+        plex_playlist.addItems(batch)
+
+def find_plex_track(track, library=None):
+    # Without a whole-library index, fall back to indexing just what Plex's
+    # title search turns up for this track.
+    if library is None:
+        library = TrackMatcher().add_plex(music.searchTracks(title=normalize_track(track["track"]["name"])))
+
+    entry = library.match(track["track"]["name"], track["track"]["artists"][0]["name"])
+    if entry:
+        print("  matched: %s - %s" % (entry.artists[0], entry.title))
+        return entry.item
+
+    return None
+
+def cached_plex_track(track, matches, library=None):
+    track_id = track["track"]["id"]
+    # A full sync has the whole library indexed, so checking again for
+    # tracks that weren't on Plex last time is cheap
+    if track_id in matches and matches[track_id] is None:
+        if not full_sync:
+            print("  cached: not on Plex")
+            return None
+    # With the index there, cached matches come from it rather than from
+    # a request each
+    elif track_id in matches and library is not None:
+        entry = library.by_key.get(matches[track_id])
+        if entry:
+            print("  cached match: %s" % entry.title)
+            return entry.item
+        print("  cached match is gone from Plex")
+    elif track_id in matches:
+        try:
+            plex_track = plex.fetchItem(matches[track_id])
+            print("  cached match: %s" % plex_track.title)
+            return plex_track
+        except plexapi.exceptions.NotFound:
+            print("  cached match is gone from Plex")
+
+    plex_track = find_plex_track(track, library)
+    matches[track_id] = plex_track.ratingKey if plex_track else None
+    return plex_track
+
+state = load_state()
+since = None if full_sync else state["last_added_at"]
+
+# A full walk touches most of the library, so index all of it up front
+# rather than searching Plex once per liked track.
+library = None
+if since is None:
+    library = TrackMatcher().add_plex(music.searchTracks())
+    print("Indexed %d Plex tracks" % len(library))
 
 albums = {}
-saved = spotify.current_user_saved_tracks(limit=50)
-while True:
-    for track in saved["items"]:
-        print("<%s> - <%s>" % (track["track"]["artists"][0]["name"], track["track"]["name"]))
-
-        for plex_track in music.searchTracks(title=normalize_track(track["track"]["name"])):
-            spotify_artist = track["track"]["artists"][0]["name"]
-
-            if plex_track.artist().title == spotify_artist:
-                print("  exact artist match: %s" % plex_track.artist().title)
-            elif plex_track.originalTitle == spotify_artist:
-                print("  exact OT artist match: %s" % plex_track.originalTitle)
-            elif compare(plex_track.artist().title, spotify_artist):
-                print("  fuzzy artist match: %s" % plex_track.artist().title)
-            elif compare(plex_track.originalTitle, spotify_artist):
-                print("  fuzzy OT artist match: %s" % plex_track.originalTitle)
-            else:
-                print("  no artist match: %s" % plex_track.artist().title)
-                continue
+spotify_additions = []
+plex_additions = []
+newest = state["last_added_at"]
+for track in saved_tracks(since=since):
+    print("<%s> - <%s>" % (track["track"]["artists"][0]["name"], track["track"]["name"]))
+    if newest is None or track["added_at"] > newest:
+        newest = track["added_at"]
+
+    plex_track = cached_plex_track(track, state["matches"], library)
+    if plex_track:
+        if plex_track.userRating:
+            print(f"    already liked: {plex_track.userRating}")
+        else:
+            print(f"    adding to Plex playlist")
+            plex_additions.append(plex_track)
+    else:
+        print("  no good match on Plex. Adding to Spotify playlist")
 
-            if track["track"]["name"] == plex_track.title:
-                print("  exact track match: %s" % plex_track.title)
-            elif compare(normalize_track(track["track"]["name"]), plex_track.title):
-                print("  fuzzy track match: %s" % plex_track.title)
-            else:
-                print("  no track match: %s" % plex_track.title)
-                continue
-
-            if plex_track.userRating:
-                print(f"    already liked: {plex_track.userRating}")
-            elif plex_playlist is None:
-                print(f"    creating and adding to Plex playlist")
-                plex_playlist = music.createPlaylist(playlist_name, items=[plex_track])
-            else:
-                print(f"    adding to playlist")
-                plex_playlist.addItems(plex_track)
-            break
+        album_ref = "%s - %s" % (track["track"]["artists"][0]["name"], track["track"]["album"]["name"])
+        if album_ref not in albums:
+            albums[album_ref] = 1
         else:
-            print("  no good match on Plex. Adding to Spotify playlist")
+            albums[album_ref] += 1
+        spotify_additions.append(track["track"]["uri"])
 
-            album_ref = "%s - %s" % (track["track"]["artists"][0]["name"], track["track"]["album"]["name"])
-            if album_ref not in albums:
-                albums[album_ref] = 1
-            else:
-                albums[album_ref] += 1
-            spotify.user_playlist_add_tracks(user["id"], spotify_playlist_id, [track["track"]["uri"]])
-    
-    if saved["next"]:
-        saved = spotify.next(saved)
-    else:
-        break
+flush_spotify(spotify_additions)
+flush_plex(plex_additions)
+print("Added %d tracks to Spotify and %d tracks to Plex" % (len(spotify_additions), len(plex_additions)))
+
+# Only move the checkpoint once the playlists have been written.
+state["last_added_at"] = newest
+save_state(state)
 
 print("Albums not found on Plex:")
 for album, count in albums.items():
@@ -0,0 +1,226 @@
+import logging
+import socket
+import struct
+import threading
+import time
+import zlib
+import numpy
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Each frame is one packet: this header then the zlib-compressed RGB frame,
+# already gamma corrected and cut to the display's size. Over TCP every
+# packet is preceded by its length. Over UDP a frame is one datagram, which
+# is plenty for the panels this drives.
+
+magic = b"MXF1"
+header = struct.Struct("<4sIHHHH")
+length = struct.Struct("<I")
+max_datagram = 65507
+
+def encode(seq, size, pixels, padding_left=0, padding_top=0):
+    return header.pack(magic, seq, size[0], size[1], padding_left, padding_top) + pixels
+
+def decode(packet):
+    """(seq, image, (padding_left, padding_top)), or None if it isn't a frame."""
+    if len(packet) < header.size:
+        return None
+    tag, seq, width, height, padding_left, padding_top = header.unpack_from(packet)
+    if tag != magic:
+        return None
+    try:
+        pixels = zlib.decompress(packet[header.size:])
+    except zlib.error:
+        return None
+    if len(pixels) != width * height * 3:
+        return None
+    return seq, Image.frombytes("RGB", (width, height), pixels), (padding_left, padding_top)
+
+class Display:
+    """One receiver that the renderer streams frames to.
+
+    prepare() turns a rendered frame's pixels into this display's
+    compressed payload: the display's window onto the frame, through its
+    own gamma tables, looked up into the same buffer every frame. send()
+    numbers and sends it, so an unchanged frame can be sent again without
+    preparing it again. A receiver that's down costs a failed send; TCP
+    connections are retried every retry seconds, not every frame.
+
+    TCP connects and sends happen on the display's own thread, so a slow
+    receiver never holds up rendering. It only ever has the newest frame
+    waiting; one it hasn't got to yet is replaced, not queued.
+    """
+
+    def __init__(self, settings, gamma, night_gamma, retry=5.0):
+        self.settings = settings
+        self.gamma = gamma
+        self.night_gamma = night_gamma
+        self.pixels = numpy.zeros((settings.height, settings.width, 3), dtype=numpy.uint8)
+        self.index = numpy.empty((settings.height, settings.width, 3), dtype=numpy.intp)
+        self.retry = retry
+        self.address = (settings.host, settings.port)
+        self.seq = 0
+        self.sock = None
+        self.retry_at = 0.0
+        self.failing = False
+        self.pending = None
+        self.closed = False
+        self.ready = threading.Condition()
+
+        if settings.transport == "udp":
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            threading.Thread(target=self._sender, name="stream %s" % settings.name, daemon=True).start()
+
+    # Any of the window that's off the frame stays black
+    def prepare(self, pixels, night):
+        s = self.settings
+        window = pixels[s.y:s.y + s.height, s.x:s.x + s.width]
+        height, width = window.shape[:2]
+        index = self.index[:height, :width]
+        numpy.copyto(index, window)
+        numpy.take(self.night_gamma if night else self.gamma, index, out=self.pixels[:height, :width], mode="clip")
+        return (s.width, s.height), zlib.compress(self.pixels, 1)
+
+    def send(self, prepared):
+        self.seq += 1
+        size, pixels = prepared
+        packet = encode(self.seq, size, pixels, self.settings.padding_left, self.settings.padding_top)
+        if self.settings.transport == "tcp":
+            with self.ready:
+                self.pending = packet
+                self.ready.notify()
+            return
+
+        try:
+            if len(packet) > max_datagram:
+                raise OSError("frame is %d bytes, too big for UDP" % len(packet))
+            self.sock.sendto(packet, self.address)
+        except OSError as err:
+            self.failed(err)
+            return
+        self.sent()
+
+    def _sender(self):
+        while True:
+            with self.ready:
+                while self.pending is None and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    break
+                packet, self.pending = self.pending, None
+
+            if not self.connect():
+                continue
+            try:
+                self.sock.sendall(length.pack(len(packet)) + packet)
+            except OSError as err:
+                self.failed(err)
+                continue
+            self.sent()
+        self.disconnect()
+
+    def sent(self):
+        if self.failing:
+            logger.warning("Streaming to %s again" % self.settings.name)
+            self.failing = False
+
+    def connect(self):
+        if self.sock:
+            return True
+        if time.monotonic() < self.retry_at:
+            return False
+        try:
+            self.sock = socket.create_connection(self.address, timeout=0.5)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return True
+        except OSError as err:
+            self.failed(err)
+            return False
+
+    def failed(self, err):
+        if not self.failing:
+            logger.warning("Can't stream to %s: %s" % (self.settings.name, err))
+            self.failing = True
+        if self.settings.transport == "tcp":
+            self.disconnect()
+            self.retry_at = time.monotonic() + self.retry
+
+    def disconnect(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    # A TCP display's thread closes its own connection on the way out
+    def close(self):
+        if self.settings.transport == "tcp":
+            with self.ready:
+                self.closed = True
+                self.ready.notify()
+        else:
+            self.disconnect()
+
+class Receiver:
+    """The receiving end: yields frames as they arrive.
+
+    Over UDP anything that's queued up is skipped to the newest frame, and
+    frames arriving out of order are dropped. A sequence number far behind
+    the last one means the sender restarted, so it's taken as the new start.
+    """
+
+    restart_gap = 100
+
+    def __init__(self, port=7000, transport="udp", host="0.0.0.0"):
+        self.transport = transport
+        self.last = 0
+        if transport == "udp":
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        if transport == "tcp":
+            self.sock.listen(1)
+
+    def _newer(self, seq):
+        return seq > self.last or self.last - seq > self.restart_gap
+
+    def _datagrams(self):
+        while True:
+            packets = [self.sock.recv(max_datagram)]
+            # Skip straight to the newest of anything that's waiting
+            while True:
+                try:
+                    packets.append(self.sock.recv(max_datagram, socket.MSG_DONTWAIT))
+                except BlockingIOError:
+                    break
+            for packet in reversed(packets):
+                frame = decode(packet)
+                if frame and self._newer(frame[0]):
+                    yield frame
+                    break
+
+    def _stream(self):
+        while True:
+            connection, address = self.sock.accept()
+            logger.warning("Streaming from %s:%d" % address)
+            self.last = 0
+            with connection, connection.makefile("rb") as f:
+                while True:
+                    size = f.read(length.size)
+                    if len(size) < length.size:
+                        break
+                    packet = f.read(length.unpack(size)[0])
+                    frame = decode(packet)
+                    if frame:
+                        yield frame
+            logger.warning("Stream from %s:%d closed" % address)
+
+    def frames(self):
+        for frame in self._datagrams() if self.transport == "udp" else self._stream():
+            self.last = frame[0]
+            yield frame
+
+    def close(self):
+        self.sock.close()
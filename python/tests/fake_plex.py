@@ -0,0 +1,79 @@
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+
+# Just enough of a Plex server for plexapi's AlertListener: a websocket
+# endpoint that sends whatever notifications the test gives it, and can
+# close the connection cleanly the way a restarting server does.
+
+guid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def frame(opcode, payload):
+    if len(payload) < 126:
+        head = struct.pack("!BB", 0x80 | opcode, len(payload))
+    elif len(payload) < 0x10000:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, len(payload))
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, len(payload))
+    return head + payload
+
+class FakePlex:
+    """A PlexServer stand-in serving notifications from 127.0.0.1."""
+
+    def __init__(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.client = None
+        self.connected = threading.Event()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            request = b""
+            while b"\r\n\r\n" not in request:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                request += data
+            if b"\r\n\r\n" not in request:
+                connection.close()
+                continue
+            headers = dict(line.split(": ", 1) for line in request.decode().split("\r\n")[1:] if ": " in line)
+            accept = base64.b64encode(hashlib.sha1(headers["Sec-WebSocket-Key"].encode() + guid).digest())
+            connection.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+            self.client = connection
+            self.connected.set()
+
+    def url(self, key, includeToken=False):
+        return "http://127.0.0.1:%d%s" % (self.port, key)
+
+    def startAlertListener(self, callback=None, callbackError=None):
+        from plexapi.alert import AlertListener
+        listener = AlertListener(self, callback, callbackError)
+        listener.start()
+        return listener
+
+    def notify(self, data):
+        self.client.sendall(frame(0x1, json.dumps({"NotificationContainer": data}).encode()))
+
+    # A clean close, as when the server shuts down
+    def drop(self):
+        self.connected.clear()
+        self.client.sendall(frame(0x8, struct.pack("!H", 1000)))
+        self.client.close()
+
+    def close(self):
+        self.server.close()
+        if self.client:
+            self.client.close()
+
+def playing(state, rating_key, offset=0, session="1"):
+    return {"type": "playing", "size": 1, "PlaySessionStateNotification": [
+        {"sessionKey": session, "ratingKey": rating_key, "state": state, "viewOffset": offset}]}
@@ -0,0 +1,79 @@
+import importlib.util
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music import PlexListener
+from fake_plex import FakePlex, playing
+
+have_plexapi = all(importlib.util.find_spec(name) for name in ("plexapi", "websocket"))
+
+class Changes:
+    def __init__(self):
+        self.count = 0
+        self.event = threading.Event()
+
+    def __call__(self):
+        self.count += 1
+        self.event.set()
+
+    def wait(self, timeout=2.0):
+        fired = self.event.wait(timeout)
+        self.event.clear()
+        return fired
+
+class TestAlert(unittest.TestCase):
+    def test_only_state_and_track_changes_count(self):
+        changes = Changes()
+        listener = PlexListener(None, changes)
+        for data, expected in [
+                (playing("playing", "10"), 1),
+                (playing("playing", "10", 5000), 1),
+                (playing("playing", "10", 10000), 1),
+                (playing("paused", "10"), 2),
+                (playing("playing", "11"), 3),
+                (playing("stopped", "11"), 4),
+                ({"type": "timeline"}, 4)]:
+            listener._alert(data)
+            self.assertEqual(changes.count, expected, data)
+        self.assertEqual(listener.sessions, {})
+
+@unittest.skipUnless(have_plexapi, "needs plexapi and websocket-client")
+class TestFakeServer(unittest.TestCase):
+    def setUp(self):
+        self.plex = FakePlex()
+        self.changes = Changes()
+        self.listener = PlexListener(self.plex, self.changes, retry=0.0)
+        self.assertTrue(self.listener.start())
+        self.assertTrue(self.plex.connected.wait(2.0))
+
+    def tearDown(self):
+        self.plex.close()
+        self.listener.stop()
+
+    def test_notifications(self):
+        self.plex.notify(playing("playing", "10"))
+        self.assertTrue(self.changes.wait())
+        self.plex.notify(playing("playing", "10", 5000))
+        self.assertFalse(self.changes.wait(0.3))
+        self.plex.notify(playing("paused", "10"))
+        self.assertTrue(self.changes.wait())
+        self.assertTrue(self.listener.alive)
+
+    def test_drop_wakes_the_poller(self):
+        self.plex.drop()
+        self.assertTrue(self.changes.wait())
+        self.assertFalse(self.listener.alive)
+
+        # and it can be started again to fall back to notifications
+        self.assertTrue(self.listener.start())
+        self.assertTrue(self.plex.connected.wait(2.0))
+        self.plex.notify(playing("playing", "12"))
+        self.assertTrue(self.changes.wait())
+        self.assertTrue(self.listener.alive)
+
+if __name__ == "__main__":
+    unittest.main()
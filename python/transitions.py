@@ -0,0 +1,95 @@
+import time
+import numpy
+from PIL import Image
+from compositor import shared_image
+
+class Transition:
+    """Blend from one frame to another over a fixed duration.
+
+    Both frames are held as uint16 arrays and each call to frame() blends
+    them into the same output image using a per-pixel weight out of 256.
+    Progress comes from the clock, so a slow frame just skips ahead rather
+    than stretching the transition.
+
+    kind is one of "crossfade", "wipe" (left to right with a soft edge) or
+    "dissolve" (pixels switch over in a fixed random order).
+    """
+
+    kinds = ("crossfade", "wipe", "dissolve")
+    wipe_edge = 8
+
+    def __init__(self, start, end, duration=1.27, kind="crossfade"):
+        if kind not in self.kinds:
+            raise ValueError("Unknown transition: %s" % kind)
+
+        end = end.convert("RGB")
+        if start is None:
+            start = Image.new("RGB", end.size, (0, 0, 0))
+        elif start.size != end.size:
+            resized = Image.new("RGB", end.size, (0, 0, 0))
+            resized.paste(start.convert("RGB"), (0, 0))
+            start = resized
+
+        self.kind = kind
+        self.duration = duration
+        self.start = numpy.asarray(start.convert("RGB"), dtype=numpy.uint16)
+        self.end = numpy.asarray(end, dtype=numpy.uint16)
+        self.end_image = end
+
+        # Weights are kept per channel: a ufunc broadcasting one weight
+        # across three channels makes its own buffer on every call
+        h, w, _ = self.end.shape
+        self.weights = numpy.zeros((h, w, 3), dtype=numpy.uint16)
+        self.inverse = numpy.zeros((h, w, 3), dtype=numpy.uint16)
+        self.work = numpy.zeros((h, w, 3), dtype=numpy.uint16)
+        self.scratch = numpy.zeros((h, w, 3), dtype=numpy.uint16)
+        self.image = shared_image((w, h))
+        self.out = self.image.pixels[..., :3]
+
+        if kind == "wipe":
+            self.columns = numpy.arange(w, dtype=numpy.float32).reshape(1, w, 1)
+            self.row = numpy.zeros((1, w, 1), dtype=numpy.float32)
+        elif kind == "dissolve":
+            self.noise = numpy.repeat(numpy.random.randint(0, 256, size=(h, w, 1)).astype(numpy.uint16), 3, axis=2)
+            self.switched = numpy.zeros((h, w, 3), dtype=bool)
+
+        self.t0 = time.monotonic()
+
+    @property
+    def progress(self):
+        return min(1.0, (time.monotonic() - self.t0) / self.duration)
+
+    @property
+    def done(self):
+        return self.progress >= 1.0
+
+    def _weigh(self, p):
+        if self.kind == "crossfade":
+            self.weights.fill(int(p * 256))
+        elif self.kind == "wipe":
+            edge = p * (self.weights.shape[1] + self.wipe_edge)
+            numpy.subtract(edge, self.columns, out=self.row)
+            numpy.multiply(self.row, 256 / self.wipe_edge, out=self.row)
+            numpy.clip(self.row, 0, 256, out=self.row)
+            numpy.copyto(self.weights, self.row, casting="unsafe")
+        else:
+            numpy.less(self.noise, int(p * 256), out=self.switched)
+            self.weights.fill(0)
+            numpy.copyto(self.weights, 256, where=self.switched)
+
+    def frame(self):
+        p = self.progress
+        if p >= 1.0:
+            return self.end_image
+
+        self._weigh(p)
+
+        # out = (start * (256 - w) + end * w) >> 8, which tops out at
+        # 255 * 256 so it all stays in uint16 buffers
+        numpy.subtract(256, self.weights, out=self.inverse)
+        numpy.multiply(self.start, self.inverse, out=self.work)
+        numpy.multiply(self.end, self.weights, out=self.scratch)
+        numpy.add(self.work, self.scratch, out=self.work)
+        numpy.right_shift(self.work, 8, out=self.work)
+        numpy.copyto(self.out, self.work, casting="unsafe")
+        return self.image
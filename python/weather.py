@@ -2,48 +2,144 @@ import http
 import urllib
 import simplejson
 import time
-from PIL import Image, ImageEnhance, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont
 from hsluv import hsluv_to_rgb
 from colorsys import rgb_to_hsv, hsv_to_rgb
-import os
 from config import config
+import config as configuration
+from atlas import IconAtlas
+from glyphs import GlyphFont
 import logging
-from skyfield.api import load, N,W, wgs84
-from pytz import timezone
+from lazy import Lazy
 from datetime import datetime
+import numpy
 
 logger = logging.getLogger(__name__)
 
+# Only needed once there's weather to draw the planets for
+skyfield = Lazy("skyfield.api")
+pytz = Lazy("pytz")
+
 def hsluv2rgb(h,s,v):
     return tuple(int(i * 256) for i in hsluv_to_rgb([h, s , v]))
 
 def ktof(k):
     return (k - 273.15) * 1.8 + 32.0
 
+# Fahrenheit thresholds and colors for the temperature ramp
+temp_ramp = [
+    (25, (57,81,127)),
+    (30, (47,71,117)),
+    (35, (38,67,111)),
+    (40, (37,79,119)),
+    (45, (39,91,128)),
+    (50, (39,103,138)),
+    (55, (40,117,147)),
+    (60, (67,129,144)),
+    (70, (155,153,106)),
+    (90, (175,91,60)),
+    (None, (139,23,60)),
+]
+
+# The ramp only changes at whole degrees, so precompute it per degree F
+# and clamp anything outside the table.
+ramp_min = -60
+ramp_max = 140
+
+def _ramp_color(temp):
+    for limit, color in temp_ramp:
+        if limit is None or temp < limit:
+            return color
+
+temp_lut = numpy.array([_ramp_color(t) for t in range(ramp_min, ramp_max + 1)], dtype=numpy.uint8)
+
+def temp_index(temp):
+    return numpy.clip(numpy.floor(ktof(temp)).astype(int), ramp_min, ramp_max) - ramp_min
+
 def temp_color(temp):
-    temp = ktof(temp)
-    if temp < 25:
-        return (57,81,127)
-    elif temp < 30:
-        return (47,71,117)
-    elif temp < 35:
-        return (38,67,111)
-    elif temp < 40:
-        return (37,79,119)
-    elif temp < 45:
-        return (39,91,128)
-    elif temp < 50:
-        return (39,103,138)
-    elif temp < 55:
-        return (40,117,147)
-    elif temp < 60:
-        return (67,129,144)
-    elif temp < 70:
-        return (155,153,106)
-    elif temp < 90:
-        return (175,91,60)
-    else:
-        return (139,23,60)
+    return tuple(int(c) for c in temp_lut[temp_index(temp)])
+
+# Fixed colors for the summary sparklines
+rain_color = hsluv2rgb(231.0, 100.0, 50.0)
+dry_color = hsluv2rgb(231.0, 0.0, 10.0)
+tick_color = hsluv2rgb(128.0, 0.0, 25.0)
+
+def brighten(rgb):
+    r, g, b = rgb
+    h, s, v = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
+    v = min(1.0, v * 1.5)
+    r, g, b = hsv_to_rgb(h, s, v)
+    return (int(r * 255), int(g * 255), int(b * 255))
+
+def shift_value(rgb, amount):
+    h, s, v = rgb_to_hsv(*map(lambda x: x / 255.0, rgb))
+    return tuple(map(lambda x: int(x*255.0), hsv_to_rgb(h, s, (v + amount) % 1.0)))
+
+class Snapshot:
+    """Everything the display reads from one weather payload, worked out once.
+
+    Built by Weather._update. Temperatures are in Fahrenheit, the colors
+    are ready to draw with, and the hourly and minutely series are NumPy
+    arrays, so nothing per frame touches the JSON or converts a unit. The
+    raw payload isn't kept. Snapshots never change after they're built;
+    a new payload makes a new one.
+    """
+
+    __slots__ = ("dt", "sunrise", "sunset", "clouds", "icon", "moon_phase", "pop",
+                 "temp", "feels_like", "steamy", "icy",
+                 "temp_text", "feelslike_text", "humidity_text", "wind_text", "pressure_text",
+                 "temp_color", "bright_color", "fg_color", "bg_color",
+                 "hourly_ticks", "hourly_colors", "hourly_rain", "minutely_rain")
+
+    def __init__(self, payload):
+        now = payload["current"]
+        hourly = payload["hourly"][:25]
+        put = lambda name, value: object.__setattr__(self, name, value)
+
+        put("dt", now["dt"])
+        put("sunrise", now["sunrise"])
+        put("sunset", now["sunset"])
+        put("clouds", now.get("clouds", 0))
+        put("icon", now["weather"][0]["icon"] if now.get("weather") else None)
+        put("moon_phase", (round(payload["daily"][0]["moon_phase"] * 8) % 8) + 11 if payload.get("daily") else 11)
+        put("pop", hourly[0]["pop"] if hourly and "pop" in hourly[0] else 0.0)
+
+        # If the "feels_like" temp is over 85 it's probably steamy outside
+        put("temp", ktof(now["temp"]))
+        put("feels_like", ktof(now["feels_like"]))
+        put("steamy", self.feels_like > 85)
+        put("icy", self.feels_like < 33)
+
+        put("temp_text", "%.0f°" % self.temp)
+        put("feelslike_text", "~%.0f°" % self.feels_like if self.steamy or self.icy else self.temp_text)
+        put("humidity_text", "%.0f%%" % now["humidity"])
+        put("wind_text", "%.0f mph" % (now["wind_speed"] * 2.237))
+        put("pressure_text", "%.1f\"" % (now["pressure"] * 0.0295301))
+
+        put("temp_color", temp_color(self.feels_like if self.steamy or self.icy else self.temp))
+        put("bright_color", brighten(self.temp_color))
+        put("fg_color", shift_value(self.temp_color, 0.25))
+        put("bg_color", shift_value(self.temp_color, -0.25))
+
+        hours = min(24, len(hourly) - 1)
+        ticks = numpy.array([time.localtime(hourly[x + 1]["dt"])[3] % 6 == 0 for x in range(hours)], dtype=bool)
+        colors = temp_lut[temp_index(numpy.array([hourly[x]["temp"] for x in range(hours)]))] if hours > 0 else numpy.zeros((0, 3), dtype=numpy.uint8)
+        rain = numpy.array([hourly[x].get("rain", {}).get("1h", 0.0) > 0.0 for x in range(hours)], dtype=bool)
+
+        # One time the payload didn't include minutely data...
+        try:
+            precip = numpy.array([m["precipitation"] for m in payload.get("minutely", [])[:64]])
+            bins = len(precip) // 2
+            minutely = precip[:bins * 2].reshape(bins, 2).sum(axis=1) > 0.0
+        except KeyError:
+            minutely = numpy.zeros(0, dtype=bool)
+
+        for name, value in (("hourly_ticks", ticks), ("hourly_colors", colors), ("hourly_rain", rain), ("minutely_rain", minutely)):
+            value.flags.writeable = False
+            put(name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot is read-only")
 
 class Weather:
     api_url = "https://api.openweathermap.org/data/3.0/onecall?lat=39.9623348&lon=-75.1927043&appid="
@@ -52,10 +148,26 @@ class Weather:
         self.api_key = api_key
         self.image_cache = image_cache
         self.p_canvas = None
+        self.snapshot = None
         self.w_canvas = Image.new('RGBA', (64, 64), (0, 0, 0))
+        self._summary_key = None
+        self.atlas = IconAtlas(image_cache=image_cache)
+        self._glyphs = {}
+        configuration.subscribe(self.reconfigure)
     
     def font(self, size):
-        return ImageFont.truetype(config["config"]["fonts"]["weather"], size)
+        return ImageFont.truetype(config["settings"].fonts.weather, size)
+
+    def reconfigure(self, old, new):
+        if old.fonts != new.fonts:
+            self._glyphs = {}
+            self._summary_key = None
+
+    # The weather screen draws its small text with fontmode "1"
+    def glyphs(self, size):
+        if size not in self._glyphs:
+            self._glyphs[size] = GlyphFont(self.font(size), fontmode="1")
+        return self._glyphs[size]
 
     def _update(self):
         try:
@@ -64,11 +176,10 @@ class Weather:
             logger.error("Problem getting weather :%s" % err)
             return 30
 
-        self._payload = simplejson.loads(r.read())
-        self._now = self._payload["current"]
+        self.snapshot = Snapshot(simplejson.loads(r.read()))
         self.p_canvas = self.planets()
         
-        if self.hour(0)["pop"] > 0.0:
+        if self.snapshot.pop > 0.0:
             return 60 * 5
         elif time.localtime()[3] <= 5:
             return 60 * 60
@@ -76,6 +187,13 @@ class Weather:
             return 60 * 15
 
     def _update_summary(self):
+        # Nothing on the summary changes unless there's a new payload, the
+        # hour ticks over, or the icon changes or finishes downloading.
+        key = (self.snapshot, time.localtime()[3], self.night, self.atlas.version)
+        if key == self._summary_key:
+            return
+        self._summary_key = key
+
         self.w_canvas = Image.new('RGBA', (64, 64), (0, 0, 0))
         
         # Weather summary is always displayed
@@ -84,112 +202,63 @@ class Weather:
 
     @property
     def night(self):
-        return time.time() > self._now["sunset"] or time.time() < self._now["sunrise"]
-
-    def temp_color(self):
-        if self.steamy() or self.icy():
-            return temp_color(ktof(self._payload["current"]["feels_like"]))
-        else:
-            return temp_color(ktof(self._payload["current"]["temp"]))
-        
-    def icon(self):
-        iconBox = Image.new('RGBA', (32, 32), (0, 0, 0))
+        return time.time() > self.snapshot.sunset or time.time() < self.snapshot.sunrise
 
+    def icon(self, size=32):
         if self.night:
-            phase = (round(self._payload["daily"][0]["moon_phase"] * 8) % 8) + 11
-            moonImage = Image.open("%s/Emojione_1F3%2.2d.svg.png" % (self.image_cache, phase)).resize((20,20))
-            moonDim = ImageEnhance.Brightness(moonImage).enhance(0.75)
-            iconBox.alpha_composite(moonDim, dest=(6, 6))
-
-        else:
-            url = "http://openweathermap.org/img/wn/%s.png" % (self._now["weather"][0]["icon"])
-            filename = "%s/weather-%s.png" % (self.image_cache, self._now["weather"][0]["icon"])
-            if not os.path.isfile(filename):
-                logger.warn("Getting %s" % url)
-                urllib.request.urlretrieve(url, filename)
-
-            iconImage = Image.open(filename)
-            iconImage = iconImage.crop((3, 3, 45, 45)).resize((32, 32))
-            iconBox.alpha_composite(iconImage, dest=(0, 0))
-
-        return iconBox
-
-    def hour(self, hour):
-        return self._payload["hourly"][hour]
-
-    def temp(self):
-        return "%.0f°" % ktof(self._payload["current"]["temp"])
-
-    # If the "feels_like" temp is over 80 it's probably steamy outside
-    def steamy(self):
-        return ktof(self._payload["current"]["feels_like"]) > 85
-
-    def icy(self):
-        return ktof(self._payload["current"]["feels_like"]) < 33
-
-    def feelslike(self):
-        if self.steamy() or self.icy():
-            return "~%.0f°" % ktof(self._payload["current"]["feels_like"])
+            return self.atlas.moon(self.snapshot.moon_phase, size)
         else:
-            return self.temp()
-
-    def humidity(self):
-        return "%.0f%%" % self._payload["current"]["humidity"]
-
-    def wind_speed(self):
-        return "%.0f mph" % (self._payload["current"]["wind_speed"] * 2.237)
-
-    def pressure(self):
-        return "%.1f\"" % (self._payload["current"]["pressure"] * 0.0295301)
+            return self.atlas.weather(self.snapshot.icon, size)
 
     def weather_summary(self):
         canvas = Image.new('RGBA', (64, 32), (0, 0, 0))
         draw = ImageDraw.Draw(canvas)
         draw.fontmode = "1"
 
-        h, s, v = rgb_to_hsv(*map(lambda x: x / 255.0, self.temp_color()))
-        fg_color = tuple(map(lambda x: int(x*255.0), hsv_to_rgb(h, s, (v + 0.25) % 1.0)))
-        bg_color = tuple(map(lambda x: int(x*255.0), hsv_to_rgb(h, s, (v - 0.25) % 1.0)))
-
-        draw.text((0,1), self.temp(), fill=fg_color, font=self.font(13), stroke_width=2, stroke_fill=bg_color)
-        text = self.humidity() + "\n" + self.wind_speed() + "\n" + self.pressure()
-        draw.multiline_text((1, 13), text, fill=(128, 128, 128), font=self.font(8), spacing=0)
+        now = self.snapshot
+        draw.text((0,1), now.temp_text, fill=now.fg_color, font=self.font(13), stroke_width=2, stroke_fill=now.bg_color)
+        text = now.humidity_text + "\n" + now.wind_text + "\n" + now.pressure_text
+        self.glyphs(8).text(canvas, (1, 13), text, (128, 128, 128))
         
-        for x in range(24):
-            t = time.localtime(self.hour(x+1)["dt"])
-            if t[3] % 6 == 0:
-                draw.line([(29, x+4), (31, x+4)], fill=hsluv2rgb(128.0,0.0,25.0))
+        strip = self.hourly_strip()
+        canvas.paste(strip, (29, 4), strip)
 
-            draw.point((30, x+4), fill=temp_color(self.hour(x)["temp"]))
+        # A little indicator of rain in the next hour. Each pixel represents two minutes.
+        bar = self.minutely_bar()
+        canvas.paste(bar, (0, 0), bar)
 
-            try:
-                if self.hour(x)["rain"]['1h'] > 0.0:
-                    draw.point((31, x+4), fill=hsluv2rgb(231.0, 100.0, 50.0))
-            except KeyError:
-                pass
+        return canvas
 
-        # A little indicator of rain in the next hour. Each pixel represents two minutes.
-        for m in range(32):
-            try: # one time the payload didn't include minutely data...
-                rain = self._payload["minutely"][2 * m]["precipitation"] + self._payload["minutely"][2 * m + 1]["precipitation"]
-                if rain > 0.0:
-                    draw.point((m, 0), fill=hsluv2rgb(231.0, 100.0, 50.0))
-                else:
-                    draw.point((m, 0), fill=hsluv2rgb(231.0, 0.0, 10.0))
+    # 24 hours of temperature (middle column) and rain (right column), with a
+    # tick across all three columns every six hours. Transparent pixels leave
+    # whatever text is underneath alone.
+    def hourly_strip(self):
+        now = self.snapshot
+        strip = numpy.zeros((24, 3, 4), dtype=numpy.uint8)
+        hours = len(now.hourly_colors)
 
-            except (KeyError, IndexError):
-                pass
+        strip[:hours][now.hourly_ticks] = tick_color + (255,)
+        strip[:hours, 1, :3] = now.hourly_colors
+        strip[:hours, 1, 3] = 255
+        strip[:hours][now.hourly_rain, 2] = rain_color + (255,)
 
-        return canvas
+        return Image.fromarray(strip, "RGBA")
+
+    def minutely_bar(self):
+        rain = self.snapshot.minutely_rain
+        bar = numpy.zeros((1, 32, 4), dtype=numpy.uint8)
+        bar[0, :len(rain)] = numpy.where(rain[:, None], rain_color + (255,), dry_color + (255,))
+
+        return Image.fromarray(bar, "RGBA")
 
     def planets(self):
-        ts = load.timescale()
-        utc = timezone('US/Eastern')
+        ts = skyfield.load.timescale()
+        utc = pytz.timezone('US/Eastern')
 
         # Load the JPL ephemeris DE421 (covers 1900-2050).
-        planets = load('de421.bsp')
+        planets = skyfield.load('de421.bsp')
         earth = planets['earth']
-        philly = earth + wgs84.latlon(39.9623348 * N, 75.1927043 * W, elevation_m=10.59)
+        philly = earth + skyfield.wgs84.latlon(39.9623348 * skyfield.N, 75.1927043 * skyfield.W, elevation_m=10.59)
 
         # Supersampling at 2x
         canvas = Image.new('RGBA', (256, 64), (0, 0, 32))
@@ -223,10 +292,7 @@ class Weather:
                 x = int(az.degrees / 360.0 * 256)
                 y = int(64 - (alt.degrees / 80.0 * 64))
                 if planet_name == "moon":
-                    phase = (((round(self._payload["daily"][0]["moon_phase"] * 8) % 8) + 11))
-                    moonImage = Image.open("%s/Emojione_1F3%2.2d.svg.png" % (self.image_cache, phase)).resize((12,12))
-                    moonDim = ImageEnhance.Brightness(moonImage).enhance(0.75)
-                    canvas.alpha_composite(moonDim, dest=(x-6, y-6))
+                    canvas.alpha_composite(self.atlas.moon(self.snapshot.moon_phase, 12), dest=(x-6, y-6))
                 else:
                     if planet_name == "saturn barycenter":
                         draw.ellipse((x-3*size, y-1, x+3*size, y+1), fill=(128,128,128))
@@ -244,9 +310,6 @@ class Weather:
     def extreme(self):
         txtImg = Image.new('RGBA', (32, 32), (0, 0, 0, 0))
         if not config["frame"].square:
-            icon = self.icon().resize((16,16))
-            txtImg.alpha_composite(icon, dest=(14,0))
-        draw = ImageDraw.Draw(txtImg)
-        draw.fontmode = "1"
-        draw.text((2, 0), self.feelslike(), self.temp_color(), font=self.font(9))
+            txtImg.alpha_composite(self.icon(16), dest=(14,0))
+        self.glyphs(9).text(txtImg, (2, 0), self.snapshot.feelslike_text, self.snapshot.temp_color)
         return txtImg